@@ -7,21 +7,50 @@ from flask import (
     Response,
 )
 import os
+import sys
+import glob
+import argparse
 import pytesseract
 from PIL import Image
 import fitz  # PyMuPDF
 import docx
+import numpy as np
 import requests
+import requests.adapters
 import genanki
+from genanki.apkg_col import APKG_COL
+from genanki.apkg_schema import APKG_SCHEMA
 import tempfile
 import re
-from collections import OrderedDict
+from collections import Counter, OrderedDict, deque
 from pathlib import Path
 import json
 import logging
+import hashlib
+import itertools
+import zipfile
+import codecs
+import mmap
+import shutil
+import unicodedata
+import math
+import sqlite3
 import time
+import random
+import asyncio
+import threading
+import multiprocessing
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import wait as wait_futures
+from contextlib import contextmanager
 from datetime import datetime
 
+try:
+    import httpx
+except ImportError:  # opcional: sólo para LLM_ASYNC
+    httpx = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -29,17 +58,773 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-progress_data = {
-    'current': 0,
-    'total': 0,
-    'status': 'idle',
-    'message': '',
-    'debug': '',
-    'partial_cards': {}
-}
+SUPPORTED_EXTENSIONS = ('.pdf', '.docx', '.txt', '.png', '.jpg', '.jpeg')
+
+# Uploads are streamed in blocks to a per-job folder (uploads/<job id>/) and
+# rejected as soon as they exceed MAX_UPLOAD_MB. Each job also spools its
+# chunk texts there instead of keeping the whole document in memory.
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_MB', '200')) * 1024 * 1024
+IO_BLOCK_SIZE = 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + IO_BLOCK_SIZE
+
+# Chunk sizing: chunks are budgeted in estimated tokens from the model context
+# (MODEL_CONTEXT_TOKENS, also sent to Ollama as num_ctx). CHUNK_MAX_TOKENS
+# overrides the computed budget.
+MODEL_CONTEXT_TOKENS = int(os.environ.get('MODEL_CONTEXT_TOKENS', '32768'))
+CHUNK_MAX_TOKENS = int(os.environ.get('CHUNK_MAX_TOKENS', '0'))
+CHUNK_CONTEXT_FRACTION = float(os.environ.get('CHUNK_CONTEXT_FRACTION', '0.25'))
+CHUNK_MIN_FILL = float(os.environ.get('CHUNK_MIN_FILL', '0.5'))
+TOKENS_PER_WORD = 1.3
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+# Revised uploads (same file name) reuse the cards of unchanged chunks from
+# the previous version stored in VERSIONS_FOLDER.
+INCREMENTAL_UPDATES = os.environ.get('INCREMENTAL_UPDATES', '1') == '1'
+VERSIONS_FOLDER = 'versions'
+os.makedirs(VERSIONS_FOLDER, exist_ok=True)
+
+# Job queue: a bounded pool of workers runs the pipeline so that POST / returns
+# immediately. MAX_QUEUED_JOBS caps how many uploads may wait for a worker.
+# Finished jobs stay in memory for JOBS_TTL_MINUTES so clients can read their
+# final status; their output remains downloadable from the result store.
+MAX_CONCURRENT_JOBS = int(os.environ.get('MAX_CONCURRENT_JOBS', '2'))
+MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', '20'))
+JOBS_TTL_MINUTES = float(os.environ.get('JOBS_TTL_MINUTES', '30'))
+job_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix='job')
+jobs = {}
+jobs_lock = threading.Lock()
+SSE_KEEPALIVE = 15
+prompts_log_lock = threading.Lock()
+
+# Independent chunks mode: every chunk is sent with only the system PROMPT (and a
+# short digest of the headings seen so far) so several chunks can be generated
+# in parallel. LLM_MAX_IN_FLIGHT bounds the requests sent to each Ollama server
+# at once across all jobs; keep it in line with OLLAMA_NUM_PARALLEL.
+INDEPENDENT_CHUNKS = os.environ.get('INDEPENDENT_CHUNKS', '0') == '1'
+HEADINGS_DIGEST = os.environ.get('HEADINGS_DIGEST', '1') == '1'
+LLM_MAX_IN_FLIGHT = int(os.environ.get('LLM_MAX_IN_FLIGHT', '4'))
+
+# Batched prompting: consecutive short chunks are packed into one request,
+# separated by "=== FRAGMENTO n ===" markers that the model repeats before the
+# cards of each chunk. A batch holds up to BATCH_MAX_CHUNKS chunks and
+# BATCH_MAX_TOKENS of text (0 = twice the chunk budget).
+BATCH_CHUNKS = os.environ.get('BATCH_CHUNKS', '0') == '1'
+BATCH_MAX_CHUNKS = int(os.environ.get('BATCH_MAX_CHUNKS', '8'))
+BATCH_MAX_TOKENS = int(os.environ.get('BATCH_MAX_TOKENS', '0'))
+
+# Structured output: LLM_JSON_OUTPUT=1 asks Ollama for JSON constrained by
+# CARDS_SCHEMA (the "format" field) instead of free text. Replies are
+# validated and only go through the text parser when they are not JSON of
+# that shape. Cards are not streamed in this mode.
+LLM_JSON_OUTPUT = os.environ.get('LLM_JSON_OUTPUT', '0') == '1'
+
+# Streaming mode: ask Ollama for its NDJSON token stream and publish each card
+# to the job as soon as its answer line is complete.
+LLM_STREAM = os.environ.get('LLM_STREAM', '0') == '1'
+
+# Ollama backend and generation options (OLLAMA_OPTIONS is a JSON object)
+OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://localhost:11434/api/chat')
+LLM_MODEL = os.environ.get('LLM_MODEL', 'mixtral:8x7b')
+LLM_OPTIONS = {'num_ctx': MODEL_CONTEXT_TOKENS, **json.loads(os.environ.get('OLLAMA_OPTIONS', '{}'))}
+
+# Several Ollama servers: OLLAMA_BACKENDS is a JSON list of objects with "url",
+# "model", "weight" and "max_concurrency"; missing fields default to OLLAMA_URL,
+# LLM_MODEL, 1 and LLM_MAX_IN_FLIGHT. Requests go to the least loaded healthy
+# server and fail over to the others on errors.
+OLLAMA_BACKENDS = json.loads(os.environ.get('OLLAMA_BACKENDS', '[]'))
+
+# HTTP client: keep-alive connections to Ollama, full-jitter exponential
+# backoff between retries (capped at LLM_BACKOFF_MAX seconds) and a circuit
+# breaker that fails fast for LLM_BREAKER_COOLDOWN seconds after
+# LLM_BREAKER_THRESHOLD consecutive failures. LLM_ASYNC=1 runs independent
+# chunks on an asyncio client instead of threads (requires httpx).
+LLM_BACKOFF_MAX = float(os.environ.get('LLM_BACKOFF_MAX', '30'))
+LLM_BREAKER_THRESHOLD = int(os.environ.get('LLM_BREAKER_THRESHOLD', '5'))
+LLM_BREAKER_COOLDOWN = float(os.environ.get('LLM_BREAKER_COOLDOWN', '30'))
+LLM_ASYNC = os.environ.get('LLM_ASYNC', '0') == '1'
+
+# Persistent cache of model replies keyed by prompt, system PROMPT, model and
+# options. An empty LLM_CACHE_PATH disables it.
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', 'llm_cache.sqlite3')
+LLM_CACHE_MAX_BYTES = int(os.environ.get('LLM_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# Result store: each finished job keeps its package, cards JSON and metadata
+# in RESULTS_FOLDER/<job id>/ so it can be downloaded again. Results older than
+# RESULTS_TTL_HOURS are deleted, and the oldest go first when the store grows
+# past RESULTS_MAX_MB.
+RESULTS_FOLDER = os.environ.get('RESULTS_FOLDER', 'results')
+RESULTS_TTL_HOURS = float(os.environ.get('RESULTS_TTL_HOURS', '72'))
+RESULTS_MAX_MB = int(os.environ.get('RESULTS_MAX_MB', '2048'))
+
+# PDF extraction: large documents are split into batches of pages that a
+# process pool extracts in parallel while the first chunks are already sent to
+# the model.
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', str(os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', '32'))
+PDF_PAGES_PER_TASK = int(os.environ.get('PDF_PAGES_PER_TASK', '8'))
+process_pool = None
+process_pool_lock = threading.Lock()
+
+# OCR fallback for scanned PDF pages (little text but embedded images). Pages
+# are rendered at OCR_DPI and the recognised text is cached by page hash.
+OCR_ENABLED = os.environ.get('OCR_ENABLED', '1') == '1'
+OCR_DPI = int(os.environ.get('OCR_DPI', '300'))
+OCR_LANG = os.environ.get('OCR_LANG', '')
+OCR_MIN_CHARS = int(os.environ.get('OCR_MIN_CHARS', '20'))
+OCR_CACHE_FOLDER = 'ocr_cache'
+os.makedirs(OCR_CACHE_FOLDER, exist_ok=True)
+
+# .apkg export: notes are inserted into the package database in transactions
+# of APKG_BATCH_SIZE notes.
+APKG_BATCH_SIZE = int(os.environ.get('APKG_BATCH_SIZE', '5000'))
+
+# Encabezados en el texto fuente: numerados ("01. Introducción") o en mayúsculas
+TEXT_HEADING_PATTERN = re.compile(r'^(?:\d{1,2}\.\s+\S.*|[A-ZÁÉÍÓÚÜÑ][A-ZÁÉÍÓÚÜÑ0-9 ,.:()-]{2,})$')
+
+# Card deduplication: before the decks are limited and packaged, cards with
+# the same normalised text, or whose word-pair Jaccard similarity reaches
+# DEDUP_THRESHOLD, are merged into the first one (keeping the longest answer).
+# Candidates come from MinHash signatures split into DEDUP_BANDS LSH bands of
+# DEDUP_ROWS rows. DEDUP_THRESHOLD=0 disables the stage.
+DEDUP_THRESHOLD = float(os.environ.get('DEDUP_THRESHOLD', '0.8'))
+DEDUP_BANDS = 16
+DEDUP_ROWS = 4
+DEDUP_WORD_PATTERN = re.compile(r'[^\W_]+')
+
+# Deck consolidation: when the model proposes more than MAX_DECKS top-level
+# decks (``Parent::Child`` decks count under their parent) they are clustered
+# by the TF-IDF similarity of their names and cards (names count
+# DECK_NAME_WEIGHT times). Decks close in the document get up to
+# DECK_ORDER_WEIGHT, so neighbouring sections merge first. Merged decks are
+# kept as subdecks of the group. Only the DECK_FEATURES most frequent terms
+# are used.
+MAX_DECKS = int(os.environ.get('MAX_DECKS', '6'))
+DECK_NAME_WEIGHT = 3
+DECK_ORDER_WEIGHT = 0.1
+DECK_FEATURES = 2048
+
+# Card parser: malformed cards in the model output are reported per job; only
+# the first PARSE_ERRORS_KEPT are kept in the job status.
+PARSE_ERRORS_KEPT = 20
+
+# Coverage check: a sentence is covered when a single card holds at least
+# COVERAGE_SENTENCE_MIN of its IDF-weighted terms; chunks with less than
+# COVERAGE_CHUNK_MIN of their sentences covered are reported.
+COVERAGE_SENTENCE_MIN = float(os.environ.get('COVERAGE_SENTENCE_MIN', '0.5'))
+COVERAGE_CHUNK_MIN = float(os.environ.get('COVERAGE_CHUNK_MIN', '0.6'))
+COVERAGE_MIN_TERMS = 3
+
+# Repair stage: new chunks that come back without cards or below
+# COVERAGE_CHUNK_MIN are sent again in the background, split into sub-chunks
+# of REPAIR_CHUNK_TOKENS (0 = a quarter of the chunk budget) holding only the
+# uncovered sentences. REPAIR_BUDGET caps the extra requests per job; 0
+# disables the stage.
+REPAIR_BUDGET = int(os.environ.get('REPAIR_BUDGET', '8'))
+REPAIR_CHUNK_TOKENS = int(os.environ.get('REPAIR_CHUNK_TOKENS', '0'))
+COVERAGE_WORD_PATTERN = re.compile(r'[^\W\d_]{3,}')
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[.!?;])\s+|\n+')
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+COVERAGE_STOPWORDS = frozenset("""
+    que los las del por con una unos unas para como mas pero sus ese esa esos esas este esta
+    estos estas eso esto son ser sea fue han hay muy sin sobre entre tambien cuando donde
+    desde hasta cual cuales porque segun puede pueden otro otra otros otras todo toda todos
+    todas mismo misma
+""".split())
+
+
+
+class JobState:
+    """Estado de un trabajo: progreso, tarjetas parciales y contexto del modelo.
+
+    Cada subida tiene su propia instancia, de modo que varios trabajos
+    concurrentes no comparten progreso ni historial conversacional. Todos los
+    accesos pasan por ``_lock`` porque el worker escribe mientras las rutas
+    ``/progress`` y ``/stream`` leen.
+
+    Cada cambio incrementa ``version`` y despierta a los clientes de
+    ``/stream``; los cambios de tarjetas se registran además en ``events``,
+    para que cada cliente reciba únicamente lo nuevo. El registro sólo guarda
+    lo que algún cliente suscrito aún no ha leído (los cursores son absolutos:
+    ``events[0]`` es el evento ``events_start``).
+    """
+
+    __slots__ = (
+        'id', 'filename', 'file_path', 'status', 'message', 'debug',
+        'current', 'total', 'partial_cards', 'streaming', 'conversation_history',
+        'error', 'result_path', 'total_cards', 'reused_chunks', 'cache_hits', 'cache_misses',
+        'coverage', 'repaired_chunks', 'merged_cards', 'timings', 'parse_errors', 'parse_error_count',
+        'created_at', 'started_at', 'finished_at', 'version', 'events', 'events_start', 'readers',
+        '_lock', '_changed',
+    )
+
+    def __init__(self, job_id, filename, file_path):
+        self.id = job_id
+        self.filename = filename
+        self.file_path = file_path
+        self.status = 'queued'
+        self.message = ''
+        self.debug = ''
+        self.current = 0
+        self.total = 0
+        self.partial_cards = OrderedDict()
+        # Tarjetas recibidas en streaming de fragmentos aún sin terminar
+        self.streaming = {}
+        # Conversational context for successive calls to Mixtral
+        self.conversation_history = []
+        self.error = None
+        self.result_path = None
+        self.total_cards = 0
+        self.reused_chunks = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coverage = None
+        self.repaired_chunks = 0
+        self.merged_cards = 0
+        # Tiempo acumulado por etapa: {etapa: [segundos, veces]}
+        self.timings = {}
+        # Primeros errores de formato de las respuestas del modelo
+        self.parse_errors = []
+        self.parse_error_count = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.version = 0
+        self.events = []
+        self.events_start = 0
+        # Cursores de los clientes suscritos: {posición: clientes}
+        self.readers = Counter()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def _notify(self, event=None):
+        """Registra un cambio (con el lock tomado) y despierta a los clientes."""
+        if event is not None and self.readers:
+            self.events.append(event)
+        self.version += 1
+        self._changed.notify_all()
+
+    def update(self, **fields):
+        """Actualiza varios campos de forma atómica."""
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            if 'partial_cards' in fields:
+                self.streaming.clear()
+                self._notify({'type': 'reset', 'cards': self._cards()})
+            else:
+                self._notify()
+
+    def add_cards(self, cards_by_deck, chunk=None):
+        """Añade tarjetas a los mazos parciales conservando el orden.
+
+        Si se indica ``chunk``, se descartan las tarjetas provisionales que
+        llegaron en streaming para ese fragmento.
+        """
+        with self._lock:
+            if chunk is not None:
+                self.streaming.pop(chunk, None)
+            for deck, cards in cards_by_deck.items():
+                self.partial_cards.setdefault(deck, []).extend(cards)
+            self._notify({
+                'type': 'cards',
+                'chunk': chunk,
+                'cards': {deck: list(cards) for deck, cards in cards_by_deck.items()},
+            })
+
+    def stream_card(self, chunk, deck, question, answer):
+        """Registra una tarjeta provisional de un fragmento en curso."""
+        with self._lock:
+            self.streaming.setdefault(chunk, []).append((deck, question, answer))
+            self._notify({'type': 'stream_card', 'chunk': chunk, 'card': (deck, question, answer)})
+
+    def clear_stream(self, chunk):
+        """Descarta las tarjetas provisionales de un fragmento."""
+        with self._lock:
+            if self.streaming.pop(chunk, None) is not None:
+                self._notify({'type': 'clear_stream', 'chunk': chunk})
+
+    def _cards(self):
+        return OrderedDict((deck, list(cards)) for deck, cards in self.partial_cards.items())
+
+    def cards(self):
+        """Copia de las tarjetas acumuladas."""
+        with self._lock:
+            return self._cards()
+
+    def _state(self):
+        return {
+            'current': self.current,
+            'total': self.total,
+            'status': self.status,
+            'message': self.message,
+            'debug': self.debug,
+        }
+
+    def _progress(self):
+        partial_cards = self._cards()
+        for chunk in sorted(self.streaming):
+            for deck, question, answer in self.streaming[chunk]:
+                partial_cards.setdefault(deck, []).append((question, answer))
+        return dict(self._state(), partial_cards=partial_cards)
+
+    def progress(self):
+        """Instantánea del progreso para ``/progress``."""
+        with self._lock:
+            return self._progress()
+
+    def subscribe(self):
+        """Punto de partida de un cliente SSE: ``(versión, cursor, instantánea)``."""
+        with self._lock:
+            snapshot = dict(
+                self._state(),
+                cards=self._cards(),
+                streaming={chunk: list(cards) for chunk, cards in self.streaming.items()},
+            )
+            cursor = self.events_start + len(self.events)
+            self.readers[cursor] += 1
+            return self.version, cursor, snapshot
+
+    def unsubscribe(self, cursor):
+        """Da de baja a un cliente SSE que había leído hasta ``cursor``."""
+        with self._lock:
+            self._move_reader(cursor, None)
+
+    def _move_reader(self, cursor, new_cursor):
+        """Actualiza la posición de un cliente y descarta los eventos ya leídos por todos."""
+        if not self.readers[cursor]:
+            return
+        self.readers[cursor] -= 1
+        if not self.readers[cursor]:
+            del self.readers[cursor]
+        if new_cursor is not None:
+            self.readers[new_cursor] += 1
+        keep = min(self.readers, default=self.events_start + len(self.events))
+        del self.events[:keep - self.events_start]
+        self.events_start = keep
+
+    def wait_changes(self, version, cursor, timeout):
+        """Espera a que el trabajo cambie respecto a ``version``.
+
+        Devuelve ``(versión, estado, eventos)`` con los eventos de tarjetas
+        posteriores a ``cursor`` (obtenido de ``subscribe``); si vence
+        ``timeout`` sin cambios, la versión devuelta es la misma.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            events = self.events[max(0, cursor - self.events_start):]
+            if events:
+                self._move_reader(cursor, cursor + len(events))
+            return self.version, self._state(), events
+
+    def count_cache(self, hit):
+        """Contabiliza una consulta a la caché de respuestas."""
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def count_repair(self):
+        """Contabiliza un fragmento enviado a reparar."""
+        with self._lock:
+            self.repaired_chunks += 1
+
+    def add_parse_errors(self, errors):
+        """Registra los errores de formato de una respuesta (se guardan los primeros)."""
+        with self._lock:
+            self.parse_error_count += len(errors)
+            self.parse_errors.extend(errors[:PARSE_ERRORS_KEPT - len(self.parse_errors)])
+
+    def add_timing(self, stage, seconds):
+        """Suma la duración de una ejecución de ``stage``."""
+        with self._lock:
+            timing = self.timings.setdefault(stage, [0.0, 0])
+            timing[0] += seconds
+            timing[1] += 1
+
+    def timing_breakdown(self):
+        """Desglose de tiempos por etapa: ``{etapa: {'seconds', 'count'}}``."""
+        with self._lock:
+            return self._timing_breakdown()
+
+    def _timing_breakdown(self):
+        return {
+            stage: {'seconds': round(seconds, 4), 'count': count}
+            for stage, (seconds, count) in self.timings.items()
+        }
+
+    def to_dict(self):
+        """Representación JSON del estado del trabajo."""
+        with self._lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                'id': self.id,
+                'filename': self.filename,
+                'status': self.status,
+                'message': self.message,
+                'error': self.error,
+                'current': self.current,
+                'total': self.total,
+                'total_cards': self.total_cards,
+                'reused_chunks': self.reused_chunks,
+                'repaired_chunks': self.repaired_chunks,
+                'merged_cards': self.merged_cards,
+                'parse_errors': {'count': self.parse_error_count, 'samples': list(self.parse_errors)},
+                'cache': {
+                    'hits': self.cache_hits,
+                    'misses': self.cache_misses,
+                    'hit_rate': self.cache_hits / lookups if lookups else 0.0,
+                },
+                'coverage': self.coverage,
+                'timings': self._timing_breakdown(),
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'result_url': f"/jobs/{self.id}/result" if self.result_path else None,
+            }
+
+
+class LLMCache:
+    """Caché persistente (SQLite) de respuestas del modelo con expulsión LRU.
+
+    Las claves son un hash del prompt de sistema, el texto enviado, el modelo
+    y las opciones de generación. Cuando el tamaño total supera ``max_bytes``
+    se eliminan las entradas usadas hace más tiempo.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS replies ("
+            "key TEXT PRIMARY KEY, reply TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS replies_last_used ON replies (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(system_prompt, prompt, model, options):
+        payload = json.dumps([system_prompt, prompt, model, options], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT reply FROM replies WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE replies SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, reply):
+        size = len(reply.encode('utf-8'))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO replies (key, reply, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, reply, size, time.time()),
+            )
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM replies").fetchone()[0]
+            if total > self.max_bytes:
+                evicted = 0
+                for old_key, old_size in self._conn.execute(
+                    "SELECT key, size FROM replies ORDER BY last_used"
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM replies WHERE key = ?", (old_key,))
+                    total -= old_size
+                    evicted += 1
+                logger.info(f"Caché de respuestas: {evicted} entradas expulsadas")
+            self._conn.commit()
+
+
+llm_cache = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES) if LLM_CACHE_PATH else None
+
+
+class ResultStore:
+    """Resultados de los trabajos terminados: paquete, tarjetas y metadatos.
+
+    Cada trabajo tiene su carpeta ``<carpeta>/<id>/`` con ``package.apkg``,
+    ``cards.json`` y ``meta.json``, de modo que se puede volver a descargar sin
+    regenerar, también tras reiniciar el servidor. Se eliminan los resultados
+    con más de ``ttl`` segundos y, si el total supera ``max_bytes``, los más
+    antiguos.
+    """
+
+    PACKAGE = 'package.apkg'
+    CARDS = 'cards.json'
+    META = 'meta.json'
+    id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, folder, ttl, max_bytes):
+        self.folder = os.path.abspath(folder)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, job_id, name):
+        """Ruta de un archivo del resultado; ``None`` si el id no es válido."""
+        if not self.id_pattern.match(job_id):
+            return None
+        return os.path.join(self.folder, job_id, name)
+
+    def package_path(self, job_id):
+        """Ruta donde el trabajo debe escribir su paquete."""
+        os.makedirs(os.path.join(self.folder, job_id), exist_ok=True)
+        return self.path(job_id, self.PACKAGE)
+
+    def save(self, job, flashcards_by_deck):
+        """Guarda tarjetas y metadatos de un trabajo cuyo paquete ya está escrito."""
+        cards_path = self.path(job.id, self.CARDS)
+        with open(cards_path, 'w', encoding='utf-8') as f:
+            json.dump(flashcards_by_deck, f, ensure_ascii=False)
+        package_path = self.path(job.id, self.PACKAGE)
+        meta = {
+            'id': job.id,
+            'filename': job.filename,
+            'created_at': job.created_at,
+            'finished_at': time.time(),
+            'total_cards': sum(len(cards) for cards in flashcards_by_deck.values()),
+            'decks': {deck: len(cards) for deck, cards in flashcards_by_deck.items()},
+            'coverage': job.coverage,
+            'timings': job.timing_breakdown(),
+            'size': os.path.getsize(package_path) + os.path.getsize(cards_path),
+            'package_url': f"/results/{job.id}/package",
+            'cards_url': f"/results/{job.id}/cards",
+        }
+        meta_path = self.path(job.id, self.META)
+        with open(f"{meta_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(f"{meta_path}.tmp", meta_path)
+        self.evict()
+        return meta
+
+    def discard(self, job_id):
+        if self.id_pattern.match(job_id):
+            shutil.rmtree(os.path.join(self.folder, job_id), ignore_errors=True)
+
+    def get(self, job_id):
+        """Metadatos de un resultado, o ``None`` si no existe o ha caducado."""
+        meta_path = self.path(job_id, self.META)
+        if meta_path is None or not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if self.ttl and time.time() - meta['finished_at'] > self.ttl:
+            return None
+        return meta
+
+    def list(self):
+        """Resultados disponibles, del más reciente al más antiguo."""
+        self.evict()
+        results = []
+        for job_id in os.listdir(self.folder):
+            meta = self.get(job_id)
+            if meta is not None:
+                results.append(meta)
+        results.sort(key=lambda meta: meta['finished_at'], reverse=True)
+        return results
+
+    def evict(self):
+        """Elimina los resultados caducados y, si hace falta, los más antiguos."""
+        with self._lock:
+            now = time.time()
+            entries = []
+            for job_id in os.listdir(self.folder):
+                meta_path = self.path(job_id, self.META)
+                if meta_path is None or not os.path.exists(meta_path):
+                    continue
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if self.ttl and now - meta['finished_at'] > self.ttl:
+                    logger.info(f"Resultado caducado eliminado: {job_id}")
+                    self.discard(job_id)
+                else:
+                    entries.append(meta)
+            entries.sort(key=lambda meta: meta['finished_at'])
+            total = sum(meta['size'] for meta in entries)
+            while entries and total > self.max_bytes:
+                meta = entries.pop(0)
+                total -= meta['size']
+                logger.info(f"Resultado eliminado por espacio: {meta['id']}")
+                self.discard(meta['id'])
+
+
+result_store = ResultStore(RESULTS_FOLDER, RESULTS_TTL_HOURS * 3600, RESULTS_MAX_MB * 1024 * 1024)
+
+
+class Histogram:
+    """Histograma con cubetas acumulativas, como los de Prometheus."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Métricas del proceso (contadores e histogramas con etiquetas).
+
+    Se acumulan entre todos los trabajos y se exponen en ``/metrics`` con el
+    formato de texto de Prometheus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._defs = {}
+        self._series = {}
+
+    def counter(self, name, help_text):
+        self._defs[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self._defs[name] = ('histogram', help_text, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(self._defs[name][2])
+            series[key].observe(value)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in pairs
+        )
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+    def render(self, gauges=()):
+        """Texto para ``/metrics``; ``gauges`` son ``(nombre, ayuda, {etiquetas: valor})``."""
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, _) in self._defs.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in self._series.get(name, {}).items():
+                    if kind == 'counter':
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+                        continue
+                    for bound, count in zip(value.buckets, value.counts):
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {value.count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {value.sum}")
+                    lines.append(f"{name}_count{self._labels(labels)} {value.count}")
+        for name, help_text, values in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values.items():
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.histogram(
+    'flashcards_stage_seconds', 'Duración de cada etapa del pipeline',
+    (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+metrics.histogram(
+    'flashcards_llm_request_seconds', 'Duración de las peticiones al modelo',
+    (0.1, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, 240),
+)
+metrics.histogram(
+    'flashcards_llm_prompt_chars', 'Tamaño de los prompts enviados al modelo',
+    (250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+metrics.histogram(
+    'flashcards_llm_response_chars', 'Tamaño de las respuestas del modelo',
+    (250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+metrics.histogram(
+    'flashcards_llm_tokens_per_second', 'Velocidad de generación del modelo',
+    (1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+metrics.counter('flashcards_llm_tokens_total', 'Tokens procesados por el modelo')
+metrics.counter('flashcards_llm_requests_total', 'Peticiones al modelo por resultado')
+metrics.counter('flashcards_llm_cache_total', 'Consultas a la caché de respuestas')
+metrics.counter('flashcards_json_replies_total', 'Respuestas JSON válidas o interpretadas como texto')
+metrics.counter('flashcards_jobs_total', 'Trabajos terminados por estado')
+metrics.counter('flashcards_cards_total', 'Tarjetas generadas')
+metrics.counter('flashcards_merged_cards_total', 'Tarjetas duplicadas fusionadas')
+
+
+def record_stage(job, stage, seconds):
+    """Registra la duración de una etapa en las métricas y en el trabajo."""
+    metrics.observe('flashcards_stage_seconds', seconds, stage=stage)
+    if job is not None:
+        job.add_timing(stage, seconds)
+
+
+@contextmanager
+def stage_timer(job, stage):
+    """Mide el bloque como una ejecución de ``stage``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(job, stage, time.perf_counter() - start)
 
-# Conversational context for successive calls to Mixtral
-conversation_history = []
+
+class TimedIterator:
+    """Envuelve un iterador y acumula el tiempo dedicado a producir sus elementos.
+
+    Sirve para medir etapas que se ejecutan en streaming, como la extracción
+    de texto, que avanzan a la par que la generación.
+    """
+
+    __slots__ = ('iterator', 'elapsed')
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+
+def record_llm_call(job, backend, prompt, reply, elapsed, usage):
+    """Registra una petición al modelo: duración, tamaños y tokens por segundo."""
+    record_stage(job, 'llm', elapsed)
+    metrics.observe('flashcards_llm_request_seconds', elapsed, backend=backend.url)
+    metrics.observe('flashcards_llm_prompt_chars', len(prompt))
+    metrics.observe('flashcards_llm_response_chars', len(reply))
+    metrics.inc('flashcards_llm_requests_total', backend=backend.url, result='ok')
+    metrics.inc('flashcards_llm_tokens_total', usage.get('prompt_eval_count', 0), kind='prompt')
+    metrics.inc('flashcards_llm_tokens_total', usage.get('eval_count', 0), kind='completion')
+    if usage.get('eval_count') and usage.get('eval_duration'):
+        tokens_per_second = usage['eval_count'] / (usage['eval_duration'] / 1e9)
+        metrics.observe('flashcards_llm_tokens_per_second', tokens_per_second)
+        logger.info(f"Modelo: {usage['eval_count']} tokens a {tokens_per_second:.1f} tokens/s")
 
 # Simplified prompt
 PROMPT = """Analiza cuidadosamente el siguiente texto. Tu tarea es generar flashcards tipo Anki, agrupadas por tema o subtema. No ignores ninguna parte del texto.
@@ -80,6 +865,52 @@ REGLAS IMPORTANTES:
 7. Verifica que todas las ideas del texto aparezcan en alguna tarjeta.
 """
 
+# Instrucciones para reenviar las frases que quedaron sin tarjetas
+REPAIR_PROMPT = """Las siguientes frases del texto quedaron sin flashcards. Genera flashcards únicamente para la información de estas frases, con el mismo formato y agrupadas por tema."""
+
+# Instrucciones que preceden a un lote de varios fragmentos (BATCH_CHUNKS)
+BATCH_PROMPT = """El texto contiene varios fragmentos, cada uno precedido por una línea "=== FRAGMENTO n ===".
+Genera las flashcards de cada fragmento por separado, en el mismo orden, y escribe antes de las tarjetas de cada uno esa misma línea "=== FRAGMENTO n ===". No mezcles tarjetas de fragmentos distintos."""
+
+# Formato JSON de las respuestas (LLM_JSON_OUTPUT)
+JSON_PROMPT = """FORMATO DE RESPUESTA: en lugar del formato de texto anterior, responde únicamente con un objeto JSON de esta forma:
+{"decks": [{"name": "Título del tema", "chunk": 1, "cards": [{"question": "¿...?", "answer": "<ul><li>...</li></ul>"}]}]}
+Cada mazo es un tema, en el orden del texto. Las respuestas siguen las mismas reglas (listas HTML, <strong>). "chunk" es el número de fragmento del que salen las tarjetas; si el texto no está dividido en fragmentos usa 1."""
+
+BATCH_JSON_PROMPT = """El texto contiene varios fragmentos, cada uno precedido por una línea "=== FRAGMENTO n ===".
+Genera las flashcards de cada fragmento por separado, en el mismo orden, en mazos con "chunk" igual a n. No mezcles tarjetas de fragmentos distintos en un mismo mazo."""
+
+SYSTEM_PROMPT = PROMPT + "\n\n" + JSON_PROMPT if LLM_JSON_OUTPUT else PROMPT
+
+CARDS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "decks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "chunk": {"type": "integer"},
+                    "cards": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "question": {"type": "string"},
+                                "answer": {"type": "string"},
+                            },
+                            "required": ["question", "answer"],
+                        },
+                    },
+                },
+                "required": ["name", "chunk", "cards"],
+            },
+        },
+    },
+    "required": ["decks"],
+}
+
 # HTML template with debug section
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -256,22 +1087,9 @@ HTML_TEMPLATE = '''
         <p id="progress-label"></p>
         <div class="debug" id="debug-label"></div>
         <div id="live-flashcards"></div>
+        <div id="streaming-flashcards"></div>
 
-        {% if flashcards_by_deck %}
-        <h2><i class="fas fa-layer-group"></i> Tarjetas Generadas</h2>
-        {% for deck, cards in flashcards_by_deck.items() %}
-            <h3>{{ deck }} ({{ cards|length }} tarjetas)</h3>
-            <div class="deck">
-                {% for q, a in cards %}
-                <div class="flashcard" onclick="this.classList.toggle('active')">
-                    <strong>{{ q }}</strong>
-                    <div class="answer">{{ a|safe }}</div>
-                </div>
-                {% endfor %}
-            </div>
-        {% endfor %}
-        <a href="{{ download_url }}" class="button"><i class="fas fa-download"></i> Descargar .apkg</a>
-        {% endif %}
+        <div id="result" data-job-id="{{ job_id or '' }}"></div>
     </div>
 
     <script>
@@ -298,7 +1116,7 @@ HTML_TEMPLATE = '''
             uploadArea.classList.remove('dragover');
             fileInput.files = e.dataTransfer.files;
             fileName.innerText = 'Archivo: ' + fileInput.files[0].name;
-            document.getElementById('upload-form').submit();
+            document.getElementById('upload-form').requestSubmit();
         });
         fileInput.addEventListener('change', () => {
             if (fileInput.files.length > 0) {
@@ -310,7 +1128,6 @@ HTML_TEMPLATE = '''
             const bar = document.getElementById('progress-bar');
             const label = document.getElementById('progress-label');
             const debugLabel = document.getElementById('debug-label');
-            const liveContainer = document.getElementById('live-flashcards');
             const container = document.getElementById('progress-container');
             if (data.total > 0) {
                 container.style.display = 'block';
@@ -318,24 +1135,6 @@ HTML_TEMPLATE = '''
                 bar.style.width = percent + '%';
                 label.innerText = data.status === 'processing' ? `Procesando: ${percent}%` : data.message || '¡Completado!';
                 debugLabel.innerText = data.debug || 'Esperando acción...';
-                if (data.partial_cards) {
-                    liveContainer.innerHTML = '';
-                    for (const [deck, cards] of Object.entries(data.partial_cards)) {
-                        const title = document.createElement('h3');
-                        title.innerText = `${deck} (${cards.length})`;
-                        liveContainer.appendChild(title);
-                        const deckDiv = document.createElement('div');
-                        deckDiv.classList.add('deck');
-                        cards.forEach(c => {
-                            const card = document.createElement('div');
-                            card.classList.add('flashcard');
-                            card.innerHTML = `<strong>${c[0]}</strong><div class="answer">${c[1]}</div>`;
-                            card.addEventListener('click', () => card.classList.toggle('active'));
-                            deckDiv.appendChild(card);
-                        });
-                        liveContainer.appendChild(deckDiv);
-                    }
-                }
             }
             if (data.status === 'error') {
                 label.innerText = data.message;
@@ -344,429 +1143,2863 @@ HTML_TEMPLATE = '''
             }
         }
 
+        // Tarjetas en vivo: las confirmadas se añaden al final de su mazo y las
+        // provisionales (streaming) se muestran aparte hasta que su fragmento termina.
+        let deckViews = {};
+        let provisional = {};
+
+        function cardElement(question, answer) {
+            const card = document.createElement('div');
+            card.classList.add('flashcard');
+            card.innerHTML = `<strong>${question}</strong><div class="answer">${answer}</div>`;
+            card.addEventListener('click', () => card.classList.toggle('active'));
+            return card;
+        }
+
+        function appendCards(deck, cards) {
+            let view = deckViews[deck];
+            if (!view) {
+                const title = document.createElement('h3');
+                const deckDiv = document.createElement('div');
+                deckDiv.classList.add('deck');
+                document.getElementById('live-flashcards').append(title, deckDiv);
+                view = deckViews[deck] = { title, deckDiv, count: 0 };
+            }
+            cards.forEach(c => view.deckDiv.appendChild(cardElement(c[0], c[1])));
+            view.count += cards.length;
+            view.title.innerText = `${deck} (${view.count})`;
+        }
+
+        function resetCards(cardsByDeck) {
+            document.getElementById('live-flashcards').innerHTML = '';
+            deckViews = {};
+            provisional = {};
+            for (const [deck, cards] of Object.entries(cardsByDeck)) {
+                appendCards(deck, cards);
+            }
+            renderProvisional();
+        }
+
+        function renderProvisional() {
+            const view = document.getElementById('streaming-flashcards');
+            view.innerHTML = '';
+            Object.keys(provisional).sort((a, b) => a - b).forEach(chunk => {
+                provisional[chunk].forEach(c => view.appendChild(cardElement(`[${c[0]}] ${c[1]}`, c[2])));
+            });
+        }
+
+        function handleEvent(data) {
+            switch (data.type) {
+                case 'snapshot':
+                    resetCards(data.cards);
+                    provisional = data.streaming;
+                    renderProvisional();
+                    updateUI(data);
+                    break;
+                case 'progress':
+                    updateUI(data);
+                    break;
+                case 'reset':
+                    resetCards(data.cards);
+                    break;
+                case 'cards':
+                    for (const [deck, cards] of Object.entries(data.cards)) {
+                        appendCards(deck, cards);
+                    }
+                    if (data.chunk !== null && provisional[data.chunk]) {
+                        delete provisional[data.chunk];
+                        renderProvisional();
+                    }
+                    break;
+                case 'stream_card':
+                    (provisional[data.chunk] = provisional[data.chunk] || []).push(data.card);
+                    document.getElementById('streaming-flashcards').appendChild(
+                        cardElement(`[${data.card[0]}] ${data.card[1]}`, data.card[2]));
+                    break;
+                case 'clear_stream':
+                    delete provisional[data.chunk];
+                    renderProvisional();
+                    break;
+            }
+        }
+
         let eventSource;
-        document.getElementById('upload-form').addEventListener('submit', () => {
-            document.getElementById('progress-label').innerText = 'Iniciando procesamiento...';
-            document.getElementById('debug-label').innerText = 'Preparando archivo...';
+
+        function showResult(jobId) {
+            fetch(`/jobs/${jobId}`)
+                .then(r => r.json())
+                .then(job => {
+                    const result = document.getElementById('result');
+                    if (job.result_url) {
+                        result.innerHTML = `<a href="${job.result_url}" class="button"><i class="fas fa-download"></i> Descargar .apkg</a>`;
+                    }
+                });
+        }
+
+        function followJob(jobId) {
             if (eventSource) {
                 eventSource.close();
             }
-            eventSource = new EventSource('/stream');
+            eventSource = new EventSource(`/stream/${jobId}`);
             eventSource.onmessage = (e) => {
                 const data = JSON.parse(e.data);
-                updateUI(data);
+                handleEvent(data);
+                if (data.status === 'completed' || data.status === 'error') {
+                    eventSource.close();
+                    showResult(jobId);
+                }
             };
+        }
+
+        document.getElementById('upload-form').addEventListener('submit', (e) => {
+            e.preventDefault();
+            document.getElementById('progress-label').innerText = 'Iniciando procesamiento...';
+            document.getElementById('debug-label').innerText = 'Preparando archivo...';
+            document.getElementById('result').innerHTML = '';
+            fetch('/', {
+                method: 'POST',
+                body: new FormData(e.target),
+                headers: { 'Accept': 'application/json' },
+            })
+                .then(r => r.json())
+                .then(job => {
+                    if (job.error) {
+                        document.getElementById('progress-label').innerText = job.error;
+                        return;
+                    }
+                    document.getElementById('debug-label').innerText = `Trabajo en cola: ${job.id}`;
+                    followJob(job.id);
+                });
         });
+
+        const initialJob = document.getElementById('result').dataset.jobId;
+        if (initialJob) {
+            followJob(initialJob);
+        }
     </script>
 </body>
 </html>
 '''
 
-def extract_text(file_path):
-    """Extrae texto de diferentes tipos de archivos."""
+def _needs_ocr(page, text):
+    """Una página necesita OCR si casi no tiene texto pero sí imágenes (escaneo)."""
+    return OCR_ENABLED and len(text.strip()) < OCR_MIN_CHARS and bool(page.get_images())
+
+
+def _ocr_page(page):
+    """Renderiza la página y la pasa por Tesseract, usando la caché por hash de página."""
+    pix = page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+    digest = hashlib.sha256(pix.samples)
+    digest.update(f"{OCR_DPI}:{OCR_LANG}".encode('utf-8'))
+    cache_path = os.path.join(OCR_CACHE_FOLDER, digest.hexdigest() + '.txt')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    # Un hilo por proceso: el paralelismo lo da el pool, no OpenMP
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+    image = Image.frombytes('L', (pix.width, pix.height), pix.samples)
+    try:
+        text = pytesseract.image_to_string(image, lang=OCR_LANG or None)
+    except (pytesseract.TesseractNotFoundError, pytesseract.TesseractError) as e:
+        logger.error(f"Error de OCR en la página {page.number + 1}: {e}")
+        return ""
+
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, cache_path)
+    return text
+
+
+def _page_text(page):
+    text = page.get_text()
+    if _needs_ocr(page, text):
+        text = _ocr_page(page) or text
+    return text
+
+
+def _pdf_page_texts(file_path, start, stop):
+    """Extrae el texto de las páginas ``[start, stop)``; se ejecuta en el pool de procesos."""
+    with fitz.open(file_path) as doc:
+        return [_page_text(doc[i]) for i in range(start, stop)]
+
+
+def _ocr_pdf_page(file_path, index):
+    """OCR de una sola página; se ejecuta en el pool de procesos."""
+    with fitz.open(file_path) as doc:
+        return _ocr_page(doc[index])
+
+
+def get_process_pool():
+    """Pool de procesos compartido para el trabajo de CPU (extracción de páginas y OCR)."""
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return process_pool
+
+
+def iter_pdf_pages(file_path):
+    """Genera el texto de cada página del PDF en orden.
+
+    Los PDF grandes se reparten por lotes de páginas en el pool de procesos;
+    las páginas se entregan en cuanto su lote termina, sin esperar al resto.
+    En los PDF pequeños sólo las páginas escaneadas se envían al pool para OCR.
+    """
+    with fitz.open(file_path) as doc:
+        page_count = doc.page_count
+        if PDF_WORKERS <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+            pending = deque()
+            for index, page in enumerate(doc):
+                text = page.get_text()
+                if not _needs_ocr(page, text):
+                    pending.append(text)
+                elif PDF_WORKERS <= 1:
+                    pending.append(_ocr_page(page) or text)
+                else:
+                    pending.append(get_process_pool().submit(_ocr_pdf_page, file_path, index))
+                while pending and isinstance(pending[0], str):
+                    yield pending.popleft()
+            for item in pending:
+                yield item if isinstance(item, str) else item.result()
+            return
+
+    per_task = max(1, min(PDF_PAGES_PER_TASK, math.ceil(page_count / PDF_WORKERS)))
+    starts = range(0, page_count, per_task)
+    stops = [min(start + per_task, page_count) for start in starts]
+    for texts in get_process_pool().map(_pdf_page_texts, [file_path] * len(starts), starts, stops):
+        yield from texts
+
+
+def iter_text(file_path, job):
+    """Genera el texto del archivo por trozos (páginas en el caso de PDF)."""
     logger.info(f"Extrayendo texto de: {file_path}")
-    progress_data['debug'] = f"Extrayendo texto del archivo: {os.path.basename(file_path)}"
+    job.update(debug=f"Extrayendo texto del archivo: {os.path.basename(file_path)}")
     try:
         ext = Path(file_path).suffix.lower()
         if ext == '.pdf':
-            text = ""
-            doc = fitz.open(file_path)
-            for page in doc:
-                text += page.get_text()
-            doc.close()
+            for number, text in enumerate(iter_pdf_pages(file_path), 1):
+                job.update(debug=f"Extrayendo texto: página {number}")
+                yield text
             logger.info("Texto extraído de PDF")
-            return text
         elif ext == '.docx':
             doc = docx.Document(file_path)
-            text = "\n".join([para.text for para in doc.paragraphs])
+            yield "\n".join([para.text for para in doc.paragraphs])
             logger.info("Texto extraído de DOCX")
-            return text
         elif ext in ('.png', '.jpg', '.jpeg'):
-            text = pytesseract.image_to_string(Image.open(file_path))
+            yield pytesseract.image_to_string(Image.open(file_path), lang=OCR_LANG or None)
             logger.info("Texto extraído de imagen")
-            return text
         elif ext == '.txt':
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
+            yield from iter_text_file(file_path)
             logger.info("Texto extraído de TXT")
-            return text
-        logger.warning(f"Formato de archivo no soportado: {ext}")
-        return ""
+        else:
+            logger.warning(f"Formato de archivo no soportado: {ext}")
     except Exception as e:
         logger.error(f"Error al extraer texto: {e}")
-        progress_data['debug'] = f"Error al extraer texto: {e}"
+        job.update(debug=f"Error al extraer texto: {e}")
         raise
 
-def call_phi3(prompt, retries=5, initial_delay=1, reset=False, system_prompt=None):
-    """Llama a la API de Phi3 utilizando un historial conversacional."""
+
+def iter_text_file(file_path):
+    """Lee un .txt por bloques a través de un mapa de memoria."""
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            for start in range(0, len(data), IO_BLOCK_SIZE):
+                yield decoder.decode(data[start:start + IO_BLOCK_SIZE])
+            yield decoder.decode(b'', final=True)
+
+
+def job_folder(job_id):
+    """Carpeta de trabajo de un trabajo: archivo subido y textos intermedios."""
+    path = os.path.join(UPLOAD_FOLDER, job_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class UploadTooLarge(Exception):
+    """El archivo subido supera ``MAX_UPLOAD_BYTES``."""
+
+
+def spool_upload(file, path, max_bytes=MAX_UPLOAD_BYTES):
+    """Copia el archivo subido a ``path`` por bloques, sin cargarlo en memoria.
+
+    Lanza ``UploadTooLarge`` en cuanto se superan ``max_bytes``.
+    """
+    size = 0
+    with open(path, 'wb') as out:
+        while True:
+            block = file.stream.read(IO_BLOCK_SIZE)
+            if not block:
+                break
+            size += len(block)
+            if size > max_bytes:
+                raise UploadTooLarge(f"El archivo supera el límite de {max_bytes // (1024 * 1024)} MB")
+            out.write(block)
+    return size
+
+
+class ChunkStore:
+    """Textos de los fragmentos de un trabajo guardados en disco.
+
+    Se añaden al final de un archivo de la carpeta del trabajo y se leen a
+    demanda mediante un mapa de memoria, de modo que un documento grande no
+    ocupa memoria durante toda la generación.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = []
+        self._file = open(path, 'w+b')
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def append(self, text):
+        data = text.encode('utf-8')
+        with self._lock:
+            start = self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self.offsets.append((start, len(data)))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __bool__(self):
+        return bool(self.offsets)
+
+    def _map(self):
+        self._file.flush()
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getitem__(self, i):
+        start, size = self.offsets[i]
+        with self._lock, self._map() as data:
+            return data[start:start + size].decode('utf-8')
+
+    def __iter__(self):
+        if not any(size for _, size in self.offsets):
+            yield from ("" for _ in self.offsets)
+            return
+        with self._lock:
+            data = self._map()
+        with data:
+            for start, size in list(self.offsets):
+                yield data[start:start + size].decode('utf-8')
+
+    def close(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class LLMRequestError(Exception):
+    """Fallo de una petición al modelo que merece reintentarse."""
+
+
+class CircuitOpenError(Exception):
+    """Todos los servidores acumulan fallos y se rechazan peticiones sin intentarlo."""
+
+
+class CircuitBreaker:
+    """Cortacircuitos: tras ``threshold`` fallos seguidos se abre ``cooldown`` segundos.
+
+    Abierto, las peticiones fallan al instante en lugar de quedarse esperando
+    a un servidor caído. Pasado el enfriamiento se deja pasar una petición de
+    prueba (semiabierto): si va bien se cierra, si falla vuelve a abrirse.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Indica si se puede enviar una petición ahora mismo."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            return time.monotonic() - self.opened_at >= self.cooldown and not self._probing
+
+    def claim(self):
+        """Reserva la petición de prueba si el circuito está semiabierto."""
+        with self._lock:
+            if self.opened_at is not None:
+                self._probing = True
+
+    def cancel_probe(self):
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.error(f"Cortacircuitos abierto tras {self.failures} fallos seguidos")
+                self.opened_at = time.monotonic()
+
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if time.monotonic() - self.opened_at >= self.cooldown else 'open'
+
+
+def reply_content(data):
+    """Texto de la respuesta de ``/api/chat`` (o ``/api/generate``).
+
+    Si el JSON no es un objeto con texto se devuelve una cadena vacía.
+    """
+    if not isinstance(data, dict):
+        return ''
+    message = data.get('message')
+    content = message.get('content') if isinstance(message, dict) else None
+    reply = content or data.get('response')
+    return reply if isinstance(reply, str) else ''
+
+
+def reply_usage(data):
+    """Contadores de tokens y tiempos que Ollama añade al final de la respuesta."""
+    if not isinstance(data, dict):
+        return {}
+    return {
+        key: data[key]
+        for key in ('prompt_eval_count', 'eval_count', 'eval_duration', 'total_duration')
+        if isinstance(data.get(key), (int, float))
+    }
+
+
+class NDJSONReply:
+    """Acumula una respuesta NDJSON de Ollama y entrega cada línea de texto completa."""
+
+    __slots__ = ('parts', 'pending', 'on_line', 'done', 'usage')
+
+    def __init__(self, on_line):
+        self.parts = []
+        self.pending = ""
+        self.on_line = on_line
+        self.done = False
+        self.usage = {}
+
+    def feed(self, raw):
+        if not raw:
+            return
+        try:
+            data = json.loads(raw)
+        except ValueError as e:
+            raise LLMRequestError(f"Respuesta en streaming inválida: {e}")
+        if not isinstance(data, dict):
+            raise LLMRequestError(f"Respuesta en streaming inválida: {raw[:100]!r}")
+        if data.get('error'):
+            raise LLMRequestError(data['error'])
+        piece = reply_content(data)
+        if piece:
+            self.parts.append(piece)
+            self.pending += piece
+            if '\n' in self.pending:
+                *lines, self.pending = self.pending.split('\n')
+                for line in lines:
+                    self.on_line(line)
+        if data.get('done'):
+            self.done = True
+            self.usage = reply_usage(data)
+
+    def finish(self):
+        if self.pending:
+            self.on_line(self.pending)
+            self.pending = ""
+        return ''.join(self.parts)
+
+
+class OllamaClient:
+    """Cliente de ``/api/chat`` con conexiones persistentes (keep-alive).
+
+    Una ``requests.Session`` mantiene un pool de hasta ``max_connections``
+    conexiones abiertas con el servidor, en lugar de abrir una por petición.
+    """
+
+    def __init__(self, url, max_connections, timeout=240):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def chat(self, payload, on_line=None):
+        """Envía la conversación; con ``on_line`` la respuesta se lee en streaming.
+
+        Devuelve ``(texto, uso)``, donde ``uso`` son los contadores de tokens
+        que informa el servidor (vacío si no los envía).
+        """
+        try:
+            if on_line is None:
+                response = self.session.post(self.url, json=payload, timeout=self.timeout)
+                response.raise_for_status()
+                data = response.json()
+                reply, usage = reply_content(data), reply_usage(data)
+            else:
+                reader = NDJSONReply(on_line)
+                with self.session.post(self.url, json=payload, timeout=self.timeout, stream=True) as response:
+                    response.raise_for_status()
+                    for raw in response.iter_lines():
+                        reader.feed(raw)
+                        if reader.done:
+                            break
+                reply, usage = reader.finish(), reader.usage
+        except (requests.RequestException, ValueError) as e:
+            raise LLMRequestError(str(e)) from e
+        return reply, usage
+
+
+class AsyncOllamaClient:
+    """Versión asyncio de ``OllamaClient`` (requiere ``httpx``).
+
+    Debe crearse y cerrarse dentro del bucle de eventos que lo usa.
+    """
+
+    def __init__(self, url, max_connections, timeout=240):
+        self.url = url
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def chat(self, payload, on_line=None):
+        try:
+            if on_line is None:
+                response = await self.client.post(self.url, json=payload)
+                response.raise_for_status()
+                data = response.json()
+                reply, usage = reply_content(data), reply_usage(data)
+            else:
+                reader = NDJSONReply(on_line)
+                async with self.client.stream('POST', self.url, json=payload) as response:
+                    response.raise_for_status()
+                    async for raw in response.aiter_lines():
+                        reader.feed(raw)
+                        if reader.done:
+                            break
+                reply, usage = reader.finish(), reader.usage
+        except (httpx.HTTPError, ValueError) as e:
+            raise LLMRequestError(str(e)) from e
+        return reply, usage
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class Backend:
+    """Un servidor de Ollama con su modelo, peso y límite de peticiones simultáneas."""
+
+    LATENCY_ALPHA = 0.2
+
+    def __init__(self, url, model, weight=1.0, max_concurrency=LLM_MAX_IN_FLIGHT):
+        self.url = url
+        self.model = model
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.client = OllamaClient(url, max_concurrency)
+        self.breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN)
+        self.in_flight = 0
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+
+    def load(self):
+        """Carga relativa si se le asignara una petición más."""
+        return (self.in_flight + 1) / self.weight
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'model': self.model,
+            'weight': self.weight,
+            'max_concurrency': self.max_concurrency,
+            'in_flight': self.in_flight,
+            'state': self.breaker.state(),
+            'latency_ms': round(self.latency * 1000) if self.latency is not None else None,
+            'requests': self.requests,
+            'failures': self.failures,
+        }
+
+
+class BackendPool:
+    """Reparte las peticiones entre varios servidores de Ollama.
+
+    Cada petición va al servidor sano menos cargado en proporción a su peso
+    (a igual carga, el de menor latencia media). Si todos están ocupados se
+    espera a que quede un hueco libre; si un servidor falla, el siguiente
+    intento evita los que ya han fallado mientras quede alguno sin probar.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    @classmethod
+    def from_config(cls, config):
+        backends = [
+            Backend(
+                entry.get('url', OLLAMA_URL),
+                entry.get('model', LLM_MODEL),
+                float(entry.get('weight', 1)),
+                int(entry.get('max_concurrency', LLM_MAX_IN_FLIGHT)),
+            )
+            for entry in config
+        ]
+        return cls(backends or [Backend(OLLAMA_URL, LLM_MODEL)])
+
+    def capacity(self):
+        """Número máximo de peticiones simultáneas entre todos los servidores."""
+        return sum(b.max_concurrency for b in self.backends)
+
+    def models(self):
+        return list(dict.fromkeys(b.model for b in self.backends))
+
+    def acquire(self, exclude=()):
+        """Reserva un hueco en el mejor servidor disponible y lo devuelve.
+
+        Lanza ``CircuitOpenError`` si todos los servidores tienen el circuito abierto.
+        """
+        with self._released:
+            while True:
+                healthy = [b for b in self.backends if b.breaker.available()]
+                if not healthy:
+                    raise CircuitOpenError("Ningún servidor del modelo responde; se reintentará más tarde")
+                candidates = [b for b in healthy if b not in exclude] or healthy
+                free = [b for b in candidates if b.in_flight < b.max_concurrency]
+                if free:
+                    backend = min(free, key=lambda b: (b.load(), b.latency or 0))
+                    backend.breaker.claim()
+                    backend.in_flight += 1
+                    return backend
+                # Se revisa periódicamente por si vence el enfriamiento de algún circuito
+                self._released.wait(timeout=1)
+
+    def release(self, backend, elapsed=None):
+        """Libera el hueco; ``elapsed`` es la duración si la petición fue bien."""
+        with self._released:
+            backend.in_flight -= 1
+            backend.requests += 1
+            if elapsed is None:
+                backend.failures += 1
+                backend.breaker.record_failure()
+            else:
+                backend.breaker.record_success()
+                if backend.latency is None:
+                    backend.latency = elapsed
+                else:
+                    backend.latency += Backend.LATENCY_ALPHA * (elapsed - backend.latency)
+            self._released.notify_all()
+
+    def abandon(self, backend):
+        """Libera el hueco de una petición cancelada sin contarla como fallo."""
+        with self._released:
+            backend.in_flight -= 1
+            backend.breaker.cancel_probe()
+            self._released.notify_all()
+
+    def untried(self, exclude):
+        """Indica si queda algún servidor sano al que no se haya enviado la petición."""
+        return any(b not in exclude and b.breaker.available() for b in self.backends)
+
+    def to_dict(self):
+        return [b.to_dict() for b in self.backends]
+
+
+llm_backends = BackendPool.from_config(OLLAMA_BACKENDS)
+
+
+def backoff_delay(attempt, initial_delay):
+    """Espera exponencial con jitter completo, para no sincronizar los reintentos."""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, initial_delay * (2 ** attempt)))
+
+
+def chat_payload(messages, stream, model=LLM_MODEL):
+    """Cuerpo de la petición a ``/api/chat`` de Ollama."""
+    payload = {
+        "model": model,
+        "messages": messages,
+        "stream": stream,
+        "options": LLM_OPTIONS,
+    }
+    if LLM_JSON_OUTPUT:
+        payload["format"] = CARDS_SCHEMA
+    return payload
+
+
+def context_messages(history):
+    """Mensajes que se envían al modelo: el de sistema y los turnos que caben.
+
+    Se reservan ``chunk_token_budget()`` tokens para la respuesta y se añaden
+    los pares pregunta/respuesta anteriores, del más reciente al más antiguo,
+    mientras quepan en ``MODEL_CONTEXT_TOKENS``. El último mensaje se envía
+    siempre.
+    """
+    system = history[:1] if history and history[0]['role'] == 'system' else []
+    turns = history[len(system):]
+    budget = MODEL_CONTEXT_TOKENS - chunk_token_budget() - sum(estimate_tokens(m['content']) for m in system)
+    start = len(turns) - 1
+    used = estimate_tokens(turns[start]['content'])
+    while start >= 2:
+        pair = sum(estimate_tokens(m['content']) for m in turns[start - 2:start])
+        if used + pair > budget:
+            break
+        used += pair
+        start -= 2
+    return system + turns[start:]
+
+
+def _begin_call(prompt, job, reset, system_prompt, history, card_stream):
+    """Prepara una llamada al modelo: historial, registro y consulta a la caché.
+
+    La caché se consulta para cada modelo configurado. Devuelve
+    ``(historial, mensajes, sistema, respuesta_en_caché)``.
+    """
+    if history is None:
+        history = job.conversation_history
     if reset:
-        conversation_history.clear()
+        history.clear()
         if system_prompt:
-            conversation_history.append({"role": "system", "content": system_prompt})
+            history.append({"role": "system", "content": system_prompt})
 
     logger.info(f"Enviando prompt a la API de Phi3 (longitud: {len(prompt)} caracteres)")
     prompt_summary = prompt[:100] + ("..." if len(prompt) > 100 else "")
-    progress_data['debug'] = (
+    job.update(debug=(
         f"Enviando prompt al modelo Phi3 ({len(prompt)} caracteres)\nResumen: {prompt_summary}"
-    )
+    ))
 
     # Save prompt to prompts_log.txt
-    with open('prompts_log.txt', 'a', encoding='utf-8') as f:
+    with prompts_log_lock, open('prompts_log.txt', 'a', encoding='utf-8') as f:
         if reset and system_prompt:
             f.write(f"[{datetime.now()}] Sistema:\n{system_prompt}\n\n")
         f.write(f"[{datetime.now()}] Usuario:\n{prompt}\n\n")
 
-    conversation_history.append({'role': 'user', 'content': prompt})
-    messages = conversation_history[-10:]
+    history.append({'role': 'user', 'content': prompt})
+    messages = context_messages(history)
+
+    system = next((m['content'] for m in history if m['role'] == 'system'), '')
+    cached_reply = None
+    if llm_cache is not None:
+        for model in llm_backends.models():
+            cached_reply = llm_cache.get(LLMCache.make_key(system, prompt, model, LLM_OPTIONS))
+            if cached_reply is not None:
+                break
+        job.count_cache(cached_reply is not None)
+        metrics.inc('flashcards_llm_cache_total', result='hit' if cached_reply is not None else 'miss')
+        if cached_reply is not None:
+            logger.info("Respuesta obtenida de la caché")
+            job.update(debug="Respuesta obtenida de la caché")
+            if card_stream is not None:
+                card_stream.reset()
+                for line in cached_reply.split('\n'):
+                    card_stream.feed(line)
+            _end_call(job, history, cached_reply)
+    return history, messages, system, cached_reply
+
+
+def _end_call(job, history, assistant_reply, model=None, system=None, prompt=None):
+    """Guarda la respuesta en el historial y, si viene del modelo, en la caché.
+
+    Sólo se guardan en la caché las respuestas con alguna tarjeta: una
+    negativa o una respuesta sin formato se volverá a pedir la próxima vez.
+    """
+    if model is not None and llm_cache is not None and reply_has_cards(assistant_reply):
+        llm_cache.put(LLMCache.make_key(system, prompt, model, LLM_OPTIONS), assistant_reply)
+    history.append({'role': 'assistant', 'content': assistant_reply})
+    if len(history) > 10:
+        # El mensaje de sistema se conserva; se olvidan los turnos más antiguos
+        del history[1 if history[0]['role'] == 'system' else 0:-9]
+
+
+def _retry_delay(job, attempt, retries, initial_delay, backend, failed, error):
+    """Registra un intento fallido y devuelve cuánto esperar antes del siguiente.
 
+    Si queda algún servidor sin probar se reintenta en él de inmediato. Lanza
+    la excepción final si no quedan intentos.
+    """
+    logger.error(f"Intento {attempt + 1}/{retries} fallido en {backend.url}: {error}")
+    job.update(debug=f"Error en intento {attempt + 1}/{retries}: {error}")
+    if attempt >= retries - 1:
+        logger.error(f"Fallo después de {retries} intentos")
+        raise Exception(f"Error al conectar con la API de Phi3 después de {retries} intentos: {error}")
+    failed.add(backend)
+    if llm_backends.untried(failed):
+        logger.info("Reintentando en otro servidor")
+        return 0
+    failed.clear()
+    delay = backoff_delay(attempt, initial_delay)
+    logger.info(f"Reintentando en {delay:.1f} segundos...")
+    return delay
+
+
+def _circuit_open(job, error):
+    logger.error(f"Petición rechazada: {error}")
+    job.update(debug=str(error))
+    return Exception(f"Error al conectar con la API de Phi3: {error}")
+
+
+def call_phi3(prompt, job, retries=5, initial_delay=1, reset=False, system_prompt=None, history=None,
+              card_stream=None):
+    """Llama a la API de Phi3 utilizando un historial conversacional.
+
+    Por defecto se usa el historial del trabajo; ``history`` permite pasar uno
+    propio para llamadas independientes que pueden ejecutarse en paralelo.
+    Con ``card_stream`` la respuesta se pide en streaming y cada tarjeta se
+    publica en el trabajo en cuanto el modelo termina de escribirla.
+    """
+    history, messages, system, assistant_reply = _begin_call(
+        prompt, job, reset, system_prompt, history, card_stream
+    )
+    if assistant_reply is not None:
+        return assistant_reply
+
+    on_line = card_stream.feed if card_stream is not None else None
+    failed = set()
     for attempt in range(retries):
+        if card_stream is not None:
+            card_stream.reset()
         try:
-            response = requests.post(
-                "http://localhost:11434/api/chat",
-                json={
-                    "model": "mixtral:8x7b",
-                    "messages": messages,
-                    "stream": False,
-                },
-                timeout=240,
+            backend = llm_backends.acquire(failed)
+        except CircuitOpenError as e:
+            raise _circuit_open(job, e)
+        start = time.monotonic()
+        try:
+            assistant_reply, usage = backend.client.chat(
+                chat_payload(messages, on_line is not None, backend.model), on_line
             )
-            response.raise_for_status()
-            data = response.json()
-            logger.info("Respuesta exitosa de la API de Phi3")
-            progress_data['debug'] = "Respuesta recibida del modelo Phi3"
-            assistant_reply = (
-                data.get('message', {}).get('content')
-                if isinstance(data, dict)
-                else ''
-            ) or data.get('response', '')
-            conversation_history.append({'role': 'assistant', 'content': assistant_reply})
-            if len(conversation_history) > 10:
-                del conversation_history[:-10]
-            return assistant_reply
-        except requests.RequestException as e:
-            logger.error(f"Intento {attempt + 1}/{retries} fallido: {e}")
-            progress_data['debug'] = f"Error en intento {attempt + 1}/{retries}: {e}"
-            if attempt < retries - 1:
-                delay = initial_delay * (2 ** attempt)
-                logger.info(f"Reintentando en {delay} segundos...")
-                time.sleep(delay)
-            else:
-                logger.error(f"Fallo después de {retries} intentos")
-                raise Exception(f"Error al conectar con la API de Phi3 después de {retries} intentos: {e}")
+        except LLMRequestError as e:
+            llm_backends.release(backend)
+            metrics.inc('flashcards_llm_requests_total', backend=backend.url, result='error')
+            time.sleep(_retry_delay(job, attempt, retries, initial_delay, backend, failed, e))
+            continue
+        except BaseException:
+            llm_backends.abandon(backend)
+            raise
+        elapsed = time.monotonic() - start
+        llm_backends.release(backend, elapsed)
+        record_llm_call(job, backend, prompt, assistant_reply, elapsed, usage)
+        logger.info(f"Respuesta exitosa de la API de Phi3 ({backend.url})")
+        job.update(debug="Respuesta recibida del modelo Phi3")
+        _end_call(job, history, assistant_reply, backend.model, system, prompt)
+        return assistant_reply
+
+
+async def call_phi3_async(clients, prompt, job, retries=5, initial_delay=1, history=None, card_stream=None):
+    """Versión asyncio de ``call_phi3`` para llamadas independientes.
+
+    ``clients`` asocia cada servidor con su ``AsyncOllamaClient``. La espera
+    entre reintentos no bloquea al resto de fragmentos en curso.
+    """
+    history, messages, system, assistant_reply = _begin_call(
+        prompt, job, False, None, history, card_stream
+    )
+    if assistant_reply is not None:
+        return assistant_reply
+
+    on_line = card_stream.feed if card_stream is not None else None
+    failed = set()
+    for attempt in range(retries):
+        if card_stream is not None:
+            card_stream.reset()
+        try:
+            # El reparto entre servidores se espera en un hilo para no bloquear el bucle
+            backend = await asyncio.to_thread(llm_backends.acquire, failed)
+        except CircuitOpenError as e:
+            raise _circuit_open(job, e)
+        start = time.monotonic()
+        try:
+            assistant_reply, usage = await clients[backend].chat(
+                chat_payload(messages, on_line is not None, backend.model), on_line
+            )
+        except LLMRequestError as e:
+            llm_backends.release(backend)
+            metrics.inc('flashcards_llm_requests_total', backend=backend.url, result='error')
+            await asyncio.sleep(_retry_delay(job, attempt, retries, initial_delay, backend, failed, e))
+            continue
+        except BaseException:
+            llm_backends.abandon(backend)
+            raise
+        elapsed = time.monotonic() - start
+        llm_backends.release(backend, elapsed)
+        record_llm_call(job, backend, prompt, assistant_reply, elapsed, usage)
+        logger.info(f"Respuesta exitosa de la API de Phi3 ({backend.url})")
+        job.update(debug="Respuesta recibida del modelo Phi3")
+        _end_call(job, history, assistant_reply, backend.model, system, prompt)
+        return assistant_reply
+
+
+def stable_id(name):
+    """ID de Anki derivado de un hash estable del nombre (no de ``hash()``, que cambia por proceso)."""
+    digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest()
+    return (1 << 30) + int.from_bytes(digest, 'big') % (1 << 30)
+
+
+# Modelo único compartido por todos los mazos
+ANKI_MODEL = genanki.Model(
+    model_id=stable_id('model:FlashcardModel'),
+    name='FlashcardModel',
+    fields=[{'name': 'Question'}, {'name': 'Answer'}],
+    templates=[{
+        'name': 'Card 1',
+        'qfmt': '{{Question}}',
+        'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}',
+    }],
+    css=".card { font-family: arial; font-size: 16px; text-align: left; }"
+)
+
 
-def create_anki_apkg(flashcards_by_deck, output_path):
+class ApkgWriter:
+    """Escribe un .apkg insertando las notas por lotes en su base de datos SQLite.
+
+    A diferencia de ``genanki.Package`` no se crea un objeto por nota: las
+    tarjetas se insertan con ``executemany`` en transacciones de
+    ``APKG_BATCH_SIZE`` notas, y los mazos pueden añadirse uno a uno. Los IDs
+    de modelo y mazo son estables y el GUID de cada nota se deriva de su
+    contenido, de modo que reimportar el paquete actualiza en vez de duplicar.
+    """
+
+    def __init__(self, output_path, timestamp=None):
+        self.output_path = output_path
+        self.timestamp = int(timestamp if timestamp is not None else time.time())
+        self.decks = OrderedDict()
+        self.guids = set()
+        self.notes = 0
+        self._ids = itertools.count(self.timestamp * 1000)
+        fd, self.db_path = tempfile.mkstemp(suffix='.anki2', dir=os.path.dirname(os.path.abspath(output_path)))
+        os.close(fd)
+        self.conn = sqlite3.connect(self.db_path)
+        # Base temporal: si el proceso muere se descarta, no hace falta durabilidad
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('PRAGMA journal_mode = MEMORY')
+        self.conn.executescript(APKG_SCHEMA)
+        self.conn.executescript(APKG_COL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_deck(self, deck_name, cards):
+        """Añade las tarjetas ``(pregunta, respuesta)`` de un mazo; las repetidas se omiten."""
+        deck_id = self.decks.setdefault(deck_name, stable_id('deck:' + deck_name))
+        notes, card_rows = [], []
+        for question, answer in cards:
+            guid = genanki.guid_for(question, answer)
+            if guid in self.guids:
+                continue
+            self.guids.add(guid)
+            note_id = next(self._ids)
+            notes.append((
+                note_id, guid, ANKI_MODEL.model_id, self.timestamp, -1, '', f"{question}\x1f{answer}",
+                question, 0, 0, '',
+            ))
+            # ``due`` conserva el orden del documento en la cola de tarjetas nuevas
+            card_rows.append((
+                next(self._ids), note_id, deck_id, 0, self.timestamp, -1, 0, 0, self.notes,
+                0, 0, 0, 0, 0, 0, 0, 0, '',
+            ))
+            self.notes += 1
+            if len(notes) >= APKG_BATCH_SIZE:
+                self._insert(notes, card_rows)
+                notes, card_rows = [], []
+        self._insert(notes, card_rows)
+
+    def _insert(self, notes, card_rows):
+        with self.conn:
+            self.conn.executemany('INSERT INTO notes VALUES(?,?,?,?,?,?,?,?,?,?,?)', notes)
+            self.conn.executemany('INSERT INTO cards VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', card_rows)
+
+    def close(self):
+        """Registra mazos y modelo en la colección y empaqueta el .apkg."""
+        decks = json.loads(self.conn.execute('SELECT decks FROM col').fetchone()[0])
+        for name, deck_id in self.decks.items():
+            decks[str(deck_id)] = genanki.Deck(deck_id, name).to_json()
+        models = json.loads(self.conn.execute('SELECT models FROM col').fetchone()[0])
+        first_deck = next(iter(self.decks.values()), 1)
+        models[str(ANKI_MODEL.model_id)] = ANKI_MODEL.to_json(self.timestamp, first_deck)
+        with self.conn:
+            self.conn.execute('UPDATE col SET decks = ?, models = ?', (json.dumps(decks), json.dumps(models)))
+        self.conn.close()
+        tmp_path = f"{self.output_path}.tmp"
+        try:
+            with zipfile.ZipFile(tmp_path, 'w') as package:
+                package.write(self.db_path, 'collection.anki2')
+                package.writestr('media', '{}')
+            os.replace(tmp_path, self.output_path)
+        finally:
+            os.remove(self.db_path)
+
+    def abort(self):
+        self.conn.close()
+        os.remove(self.db_path)
+
+
+def create_anki_apkg(flashcards_by_deck, output_path, job):
     """Crea un archivo .apkg para Anki."""
     logger.info(f"Creando archivo .apkg en: {output_path}")
-    progress_data['debug'] = "Creando archivo Anki (.apkg)"
+    job.update(debug="Creando archivo Anki (.apkg)")
     try:
-        my_package = genanki.Package([])
-        for deck_name, cards in flashcards_by_deck.items():
-            model = genanki.Model(
-                model_id=abs(hash(deck_name)) % (10 ** 10),
-                name='FlashcardModel',
-                fields=[{'name': 'Question'}, {'name': 'Answer'}],
-                templates=[{
-                    'name': 'Card 1',
-                    'qfmt': '{{Question}}',
-                    'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}',
-                }],
-                css=".card { font-family: arial; font-size: 16px; text-align: left; }"
-            )
-            deck = genanki.Deck(
-                deck_id=abs(hash(deck_name)) % (10 ** 10),
-                name=deck_name,
-            )
-            for question, answer in cards:
-                deck.add_note(genanki.Note(model=model, fields=[question, answer]))
-            my_package.decks.append(deck)
-        my_package.write_to_file(output_path)
-        logger.info("Archivo .apkg creado exitosamente")
-        progress_data['debug'] = "Archivo .apkg creado"
+        with stage_timer(job, 'package'), ApkgWriter(output_path) as writer:
+            for deck_name, cards in flashcards_by_deck.items():
+                writer.add_deck(deck_name, cards)
+        logger.info(f"Archivo .apkg creado exitosamente ({writer.notes} notas)")
+        job.update(debug="Archivo .apkg creado")
     except Exception as e:
         logger.error(f"Error al crear .apkg: {e}")
-        progress_data['debug'] = f"Error al crear .apkg: {e}"
+        job.update(debug=f"Error al crear .apkg: {e}")
         raise
 
-def parse_phi3_output(output):
-    """Parsea la salida de Phi3 para extraer flashcards."""
-    logger.info("Parseando salida de Phi3")
-    progress_data['debug'] = "Parseando respuesta del modelo"
-    try:
-        flashcards = OrderedDict()
-        current_deck = "General"
-        lines = output.strip().split('\n')
-        question = ""
-        answer = ""
-        q_pattern = re.compile(r'^(?:preg(?:unta)?|question|q)\s*[:\-]?\s*(.*)', re.I)
-        a_pattern = re.compile(r'^(?:resp(?:uesta)?|answer|a)\s*[:\-]?\s*(.*)', re.I)
-        heading_pattern = re.compile(r'^(?:\d{1,2}\.|[IVX]+\.)?\s*[A-ZÁÉÍÓÚÜÑ0-9 ,.:-]+$', re.I)
-
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith('---'):
-                continue
 
-            q_match = q_pattern.match(line)
-            a_match = a_pattern.match(line)
+class CardParser:
+    """Máquina de estados de una pasada para la salida del modelo.
+
+    Cada línea se clasifica por su primer carácter y, como mucho, una
+    expresión anclada (las líneas con el formato exacto de ``PROMPT`` ni
+    eso): separador ``---``, marcador de fragmento, encabezado ``[Tema]`` o
+    ``# Tema``, pregunta, respuesta o texto. ``parse`` recorre la
+    respuesta completa y ``feed`` recibe una línea cada vez (streaming); ambos
+    cierran cada tarjeta al llegar el separador, la siguiente pregunta o
+    encabezado, o el final.
+
+    Las respuestas pueden ocupar varias líneas (listas HTML o con guiones);
+    tras una línea en blanco sólo continúan con HTML o viñetas, y entonces
+    una línea corta con mayúscula inicial ("Tratamiento empírico") abre un
+    mazo. Sin línea en blanco sólo una línea en mayúsculas corta la respuesta.
+    Los problemas de cada tarjeta (pregunta sin respuesta, respuesta cortada
+    por un encabezado, lista sin cerrar...) y el texto fuera de las tarjetas
+    se anotan en ``errors`` en lugar de descartarse sin aviso.
+
+    Con ``chunk_ids`` (respuesta a un lote de fragmentos) las líneas
+    ``=== FRAGMENTO n ===`` indican a qué fragmento pertenecen las tarjetas
+    siguientes, que se acumulan además en ``by_chunk``.
+    """
+
+    __slots__ = (
+        'current_deck', 'question', 'answer', 'depth', 'blank', 'card_chunk',
+        'line', 'cards', 'chunk', 'by_chunk', 'errors', 'stray',
+    )
 
-            if q_match:
-                question = q_match.group(1).strip()
-                continue
-            if a_match and question:
-                answer = a_match.group(1).strip()
-                flashcards.setdefault(current_deck, []).append((question, answer))
-                question, answer = "", ""
-                continue
+    keyword_pattern = re.compile(r"""
+        (?:[-*•][ \t]+|\d{1,3}[.)][ \t]+)?(?:\*\*)?
+        (?:
+            (?P<question>(?:pregunta|question)(?:[ \t]*\d+)?(?:\*\*)?[ \t]*(?:[:\-]|(?=¿))|(?:preg|p|q)(?:[ \t]*\d+)?(?:\*\*)?[ \t]*:)
+          | (?P<answer>(?:respuesta|answer)(?:[ \t]*\d+)?(?:\*\*)?[ \t]*[:\-]|(?:resp|r|a)(?:[ \t]*\d+)?(?:\*\*)?[ \t]*:)
+        )
+        (?:\*\*)?[ \t]*
+    """, re.I | re.X)
+    keyword_starts = frozenset('pPqQrRaA-*•0123456789')
+    delimiter_pattern = re.compile(r'(?:-{3,}|\*{3,}|_{3,})$')
+    chunk_pattern = re.compile(r'=+\s*FRAGMENTO\s+(\d+)\s*=+$', re.I)
+    topic_pattern = re.compile(r'(?:#{1,6}\s*)?\[([^\]]+)\]\s*:?$|#{1,6}\s+(.*)$')
+    # Encabezados sin corchetes fuera de una tarjeta: numerados ("01. Sepsis")
+    # o en mayúsculas ("DIARREA AGUDA")
+    heading_pattern = re.compile(r'(?:\d{1,2}|[IVX]+)\.\s+[^\W\d_].*|[A-ZÁÉÍÓÚÜÑ][A-ZÁÉÍÓÚÜÑ0-9 ,.:()-]*$')
+    # Dentro de una respuesta sólo cierra la tarjeta una línea en mayúsculas o,
+    # tras una línea en blanco, una línea corta con mayúscula inicial y sin
+    # puntuación final ("Tratamiento empírico")
+    answer_heading_pattern = re.compile(r'[A-ZÁÉÍÓÚÜÑ][A-ZÁÉÍÓÚÜÑ0-9 ,.:()-]{2,}$')
+    title_heading_pattern = re.compile(r'[A-ZÁÉÍÓÚÜÑ][\w()-]*(?:[ \t]+[\w()-]+){0,5}$')
+    bold_heading_pattern = re.compile(r'\*\*([^*]+)\*\*:?$')
+    bullet_pattern = re.compile(r'(?:[-*•]|\d{1,3}[.)])\s+(.*)')
+    list_tag_pattern = re.compile(r'<(/?)(?:ul|ol)\b', re.I)
+
+    def __init__(self, chunk_ids=None):
+        self.current_deck = "General"
+        self.question = None
+        self.answer = None
+        self.depth = 0
+        self.blank = False
+        self.card_chunk = None
+        self.line = 0
+        self.cards = OrderedDict()
+        self.chunk = chunk_ids[0] if chunk_ids else None
+        self.by_chunk = OrderedDict((i, OrderedDict()) for i in chunk_ids or ())
+        self.errors = []
+        # Primera línea de texto fuera de las tarjetas: (línea, texto)
+        self.stray = None
+
+    def parse(self, output):
+        """Procesa una respuesta completa y devuelve ``cards``."""
+        feed = self.feed
+        for line in output.splitlines():
+            feed(line)
+        self.finish()
+        return self.cards
+
+    def finish(self):
+        """Cierra la tarjeta pendiente al terminar la respuesta."""
+        card = self._close()
+        if not self.cards and not self.errors and self.stray:
+            # Una respuesta con texto pero sin ninguna tarjeta no debe pasar inadvertida
+            self.line, text = self.stray
+            self._error("Respuesta sin tarjetas reconocibles", text)
+        return card
+
+    def feed(self, line):
+        """Procesa una línea; devuelve ``(fragmento, mazo, pregunta, respuesta)`` si cierra una tarjeta."""
+        self.line += 1
+        line = line.strip()
+        if not line:
+            if self.answer:
+                self.blank = True
+            return None
+        first = line[0]
+
+        # Formato pedido en PROMPT, sin pasar por las expresiones regulares
+        if first == 'P' and line.startswith('Pregunta:'):
+            return self._question(line[9:].lstrip())
+        if first == 'R' and line.startswith('Respuesta:'):
+            return self._answer(line[10:].lstrip())
+        if line == '---':
+            return self._close()
+
+        if first in self.keyword_starts:
+            match = self.keyword_pattern.match(line)
+            if match:
+                if match.lastgroup == 'question':
+                    return self._question(line[match.end():])
+                return self._answer(line[match.end():])
+            if first in '-*' and self.delimiter_pattern.match(line):
+                return self._close()
+        elif first == '=':
+            match = self.chunk_pattern.match(line)
+            if match:
+                card = self._close()
+                # Los marcadores numeran los fragmentos desde 1
+                index = int(match.group(1)) - 1
+                if index in self.by_chunk:
+                    self.chunk = index
+                elif self.by_chunk:
+                    self._error(f"Marcador de fragmento desconocido: {match.group(1)}")
+                return card
+        elif first == '_':
+            if self.delimiter_pattern.match(line):
+                return self._close()
+        elif first in '[#':
+            match = self.topic_pattern.match(line)
+            if match:
+                card = self._close()
+                self._set_deck(match.group(1) or match.group(2))
+                return card
+
+        if self.answer is not None:
+            capitals = first.isupper() and self.answer_heading_pattern.match(line) is not None
+            if self.depth > 0 or first == '<' or self.bullet_pattern.match(line):
+                continues = True
+            else:
+                continues = not (self.blank or capitals)
+            if continues:
+                self.blank = False
+                self._add_answer(line)
+                return None
+            after_blank = self.blank
+            question = " ".join(self.question)
+            card = self._close()
+            if capitals or first.isupper() and self.title_heading_pattern.match(line):
+                if not after_blank:
+                    self._error("Respuesta cortada por un encabezado", question)
+                self._set_deck(line)
+            else:
+                self._outside_text(line)
+            return card
+        if self.question is not None:
+            self.question.append(line)
+            return None
+        self._outside_text(line)
+        return None
+
+    def _question(self, value):
+        card = self._close()
+        self.question = [value] if value else []
+        self.card_chunk = self.chunk
+        return card
+
+    def _answer(self, value):
+        if self.question is None or self.answer is not None:
+            card = self._close()
+            self._error("Respuesta sin pregunta", value)
+            return card
+        self.blank = False
+        self.answer = []
+        self._add_answer(value)
+        return None
+
+    def _error(self, message, text=""):
+        self.errors.append({'chunk': self.chunk, 'line': self.line, 'error': message, 'text': text[:80]})
+
+    def _add_answer(self, line):
+        if not line:
+            return
+        if '<' in line:
+            for closing in self.list_tag_pattern.findall(line):
+                self.depth += -1 if closing else 1
+        self.answer.append(line)
+
+    def _outside_text(self, line):
+        if self.stray is None:
+            self.stray = (self.line, line)
+        # Si la línea parece un encabezado, la usamos como nombre de mazo
+        bold = self.bold_heading_pattern.match(line)
+        if bold:
+            self._set_deck(bold.group(1))
+        elif self.heading_pattern.match(line):
+            self._set_deck(line)
+        else:
+            self._error("Texto fuera de una tarjeta", line)
+
+    def _set_deck(self, name):
+        self.current_deck = name.strip().strip('*-= ').rstrip(':').strip() or "General"
+
+    def _answer_html(self, lines):
+        if len(lines) == 1:
+            return lines[0]
+        if any('<' in line for line in lines):
+            return "\n".join(lines)
+        bullets = [self.bullet_pattern.match(line) for line in lines]
+        if all(bullets[1:]):
+            # Lista con guiones: se convierte en lista HTML
+            head = [] if bullets[0] else [lines[0]]
+            items = [match.group(1) for match in bullets if match]
+            return "".join(head) + "<ul>" + "".join(f"<li>{item}</li>" for item in items) + "</ul>"
+        return "<br>".join(lines)
+
+    def _close(self):
+        """Cierra la tarjeta en curso y la devuelve si es válida."""
+        question, answer, depth = self.question, self.answer, self.depth
+        if question is None:
+            return None
+        self.question = self.answer = None
+        self.depth = 0
+        self.blank = False
+        question = " ".join(question)
+        if answer is None:
+            self._error("Pregunta sin respuesta", question)
+            return None
+        if not answer:
+            self._error("Respuesta vacía", question)
+            return None
+        if not question:
+            self._error("Pregunta vacía", answer[0])
+            return None
+        answer = self._answer_html(answer)
+        if depth > 0:
+            self._error("Lista HTML sin cerrar", question)
+            if answer.count('<li') > answer.count('</li>'):
+                answer += "</li>"
+            answer += "</ul>" * depth
+        deck = self.current_deck
+        self.cards.setdefault(deck, []).append((question, answer))
+        if self.by_chunk:
+            self.by_chunk[self.card_chunk].setdefault(deck, []).append((question, answer))
+        return self.card_chunk, deck, question, answer
+
+
+class CardStream:
+    """Envía al trabajo las tarjetas de una respuesta en streaming.
+
+    ``call_phi3`` llama a ``feed`` con cada línea completa y a ``reset`` al
+    empezar cada intento, para descartar lo recibido en intentos fallidos.
+    ``chunks`` son los fragmentos enviados en la petición (varios en un lote).
+    """
+
+    __slots__ = ('job', 'chunks', 'parser')
+
+    def __init__(self, job, chunks):
+        self.job = job
+        self.chunks = chunks
+        self.parser = CardParser(chunks)
+
+    def feed(self, line):
+        card = self.parser.feed(line)
+        if card:
+            self.job.stream_card(*card)
 
-            # Si la línea parece un encabezado, la usamos como nombre de mazo
-            if not question and not answer and heading_pattern.match(line):
-                current_deck = line.rstrip(':').strip() or "General"
+    def reset(self):
+        self.parser = CardParser(self.chunks)
+        for chunk in self.chunks:
+            self.job.clear_stream(chunk)
+
+
+def parse_phi3_output(output, job, chunk_ids=None):
+    """Parsea la salida de Phi3 para extraer flashcards.
+
+    Con ``chunk_ids`` la salida corresponde a un lote de fragmentos y se
+    devuelven las tarjetas de cada uno: ``{fragmento: {mazo: tarjetas}}``.
+    """
+    logger.info("Parseando salida de Phi3")
+    job.update(debug="Parseando respuesta del modelo")
+    try:
+        with stage_timer(job, 'parse'):
+            parser = CardParser(chunk_ids)
+            flashcards = parser.parse(output)
+        if parser.errors:
+            logger.warning(f"Errores de formato en la respuesta: {len(parser.errors)}")
+            job.add_parse_errors(parser.errors)
 
         logger.info(f"Flashcards parseadas: {sum(len(v) for v in flashcards.values())} tarjetas")
-        progress_data['debug'] = f"Flashcards parseadas: {sum(len(v) for v in flashcards.values())} tarjetas"
-        return flashcards
+        job.update(debug=f"Flashcards parseadas: {sum(len(v) for v in flashcards.values())} tarjetas")
+        return parser.by_chunk if chunk_ids else flashcards
     except Exception as e:
         logger.error(f"Error al parsear salida de Phi3: {e}")
-        progress_data['debug'] = f"Error al parsear respuesta: {e}"
+        job.update(debug=f"Error al parsear respuesta: {e}")
         raise
 
-def limit_decks(cards_by_deck, max_decks=6):
-    """Reduce el número de mazos manteniendo el orden.
 
-    Si existen más de ``max_decks`` se fusionan los excedentes en un mazo
-    llamado ``General`` colocado en la posición donde aparecería el primer
-    mazo descartado. De esta manera se respeta la secuencia original del
-    documento.
+def json_decks(output):
+    """Lista ``decks`` de una respuesta JSON o ``None`` si no tiene esa forma."""
+    text = output.strip()
+    if text.startswith('```'):
+        # Bloque de código markdown alrededor del JSON
+        text = text.split('\n', 1)[-1].rsplit('```', 1)[0]
+    try:
+        decks = json.loads(text)['decks']
+    except (ValueError, KeyError, TypeError):
+        return None
+    return decks if isinstance(decks, list) else None
+
+
+def json_card(card):
+    """``(pregunta, respuesta)`` de una tarjeta JSON o ``None`` si está incompleta."""
+    question = card.get('question') if isinstance(card, dict) else None
+    answer = card.get('answer') if isinstance(card, dict) else None
+    if not (isinstance(question, str) and question.strip() and isinstance(answer, str) and answer.strip()):
+        return None
+    return question.strip(), answer.strip()
+
+
+def reply_has_cards(output):
+    """Si la respuesta contiene al menos una tarjeta válida.
+
+    Sigue el mismo camino que ``parse_reply`` pero sin registrar errores en el
+    trabajo: se usa para decidir si la respuesta merece guardarse en la caché.
+    """
+    decks = json_decks(output) if LLM_JSON_OUTPUT else None
+    if decks is not None:
+        return any(
+            json_card(card) is not None
+            for deck in decks if isinstance(deck, dict) and isinstance(deck.get('cards'), list)
+            for card in deck['cards']
+        )
+    return any(CardParser().parse(output).values())
+
+
+def parse_json_output(output, job, chunk_ids=None):
+    """Extrae las flashcards de una respuesta JSON con la forma de ``CARDS_SCHEMA``.
+
+    Devuelve lo mismo que ``parse_phi3_output`` o ``None`` si la respuesta no
+    es un JSON con esa forma. Las tarjetas incompletas y los mazos de un
+    fragmento desconocido se descartan y se registran como errores.
+    """
+    decks = json_decks(output)
+    if decks is None:
+        return None
+
+    flashcards = OrderedDict()
+    by_chunk = OrderedDict((i, OrderedDict()) for i in chunk_ids or ())
+    errors = []
+    for deck in decks:
+        if not isinstance(deck, dict) or not isinstance(deck.get('cards'), list):
+            errors.append({'chunk': None, 'line': None, 'error': "Mazo sin tarjetas", 'text': str(deck)[:80]})
+            continue
+        name = deck.get('name')
+        name = name.strip() if isinstance(name, str) and name.strip() else "General"
+        chunk = None
+        if chunk_ids:
+            # Los fragmentos se numeran desde 1
+            number = deck.get('chunk')
+            chunk = number - 1 if isinstance(number, int) else None
+            if chunk not in by_chunk:
+                errors.append({'chunk': None, 'line': None, 'error': f"Fragmento desconocido: {number}", 'text': name})
+                continue
+        for card in deck['cards']:
+            pair = json_card(card)
+            if pair is None:
+                errors.append({'chunk': chunk, 'line': None, 'error': "Tarjeta incompleta", 'text': str(card)[:80]})
+                continue
+            flashcards.setdefault(name, []).append(pair)
+            if chunk_ids:
+                by_chunk[chunk].setdefault(name, []).append(pair)
+    if errors:
+        logger.warning(f"Errores de formato en la respuesta: {len(errors)}")
+        job.add_parse_errors(errors)
+    logger.info(f"Flashcards parseadas (JSON): {sum(len(v) for v in flashcards.values())} tarjetas")
+    job.update(debug=f"Flashcards parseadas: {sum(len(v) for v in flashcards.values())} tarjetas")
+    return by_chunk if chunk_ids else flashcards
+
+
+def parse_reply(output, job, chunk_ids=None):
+    """Tarjetas de una respuesta del modelo.
+
+    Con ``LLM_JSON_OUTPUT`` se lee como JSON y sólo si no es válido se pasa
+    al parser de texto.
     """
-    if len(cards_by_deck) <= max_decks:
+    if LLM_JSON_OUTPUT:
+        with stage_timer(job, 'parse'):
+            cards = parse_json_output(output, job, chunk_ids)
+        metrics.inc('flashcards_json_replies_total', result='fallback' if cards is None else 'ok')
+        if cards is not None:
+            return cards
+        logger.warning("La respuesta no es JSON válido; se usa el parser de texto")
+        job.update(debug="Respuesta sin JSON válido; se interpreta como texto")
+    return parse_phi3_output(output, job, chunk_ids)
+
+
+def card_words(text):
+    """Palabras de una tarjeta sin HTML, acentos, mayúsculas ni puntuación."""
+    text = unicodedata.normalize('NFKD', HTML_TAG_PATTERN.sub(' ', text).lower())
+    return DEDUP_WORD_PATTERN.findall(text.encode('ascii', 'ignore').decode())
+
+
+class MinHasher:
+    """Firmas MinHash con ``permutations`` funciones hash universales.
+
+    Las semillas son fijas para que el resultado no cambie entre ejecuciones.
+    """
+
+    # Primo mayor que 2**32; con valores < 2**32 y coeficientes < 2**31 los
+    # productos caben en uint64
+    prime = 4294967311
+
+    def __init__(self, permutations, seed=1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2 ** 31, permutations, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, 2 ** 31, permutations, dtype=np.uint64)[:, None]
+
+    def signatures(self, values, starts, block=1 << 16):
+        """Firmas de los conjuntos ``values[starts[k]:starts[k + 1]]`` (ninguno vacío).
+
+        Devuelve una matriz ``(conjuntos, permutaciones)``. Se procesan bloques
+        de unos ``block`` valores para acotar la memoria.
+        """
+        bounds = np.append(starts, len(values))
+        result = np.empty((len(starts), len(self.a)), dtype=np.uint64)
+        first = 0
+        while first < len(starts):
+            last = max(first + 1, int(np.searchsorted(bounds, bounds[first] + block, side='right')) - 1)
+            last = min(last, len(starts))
+            hashed = (self.a * values[bounds[first]:bounds[last]] + self.b) % np.uint64(self.prime)
+            result[first:last] = np.minimum.reduceat(hashed, bounds[first:last] - bounds[first], axis=1).T
+            first = last
+        return result
+
+
+def lsh_buckets(signatures, bands, rows):
+    """Grupos de filas con la misma banda de firma (candidatos a duplicado)."""
+    multipliers = np.arange(1, 2 * rows, 2, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    for band in range(bands):
+        # Resumen de la banda; una colisión sólo añade un candidato que luego se descarta
+        keys = (signatures[:, band * rows:(band + 1) * rows] * multipliers).sum(axis=1)
+        order = np.argsort(keys, kind='stable')
+        ordered = keys[order]
+        repeated = np.flatnonzero(ordered[1:] == ordered[:-1])
+        if not len(repeated):
+            continue
+        # Tramos de claves repetidas: empiezan donde la anterior no se repite
+        firsts = repeated[np.insert(np.diff(repeated) > 1, 0, True)]
+        lasts = repeated[np.append(np.diff(repeated) > 1, True)] + 2
+        order = order.tolist()
+        for first, last in zip(firsts.tolist(), lasts.tolist()):
+            yield order[first:last]
+
+
+def deduplicate_cards(cards_by_deck, threshold=DEDUP_THRESHOLD):
+    """Fusiona las tarjetas repetidas o casi iguales, en cualquier mazo.
+
+    Cada grupo de duplicados se queda en la posición y el mazo de su primera
+    tarjeta, con la respuesta más larga del grupo. Los mazos que quedan
+    vacíos desaparecen. Devuelve ``(mazos, tarjetas_fusionadas)``.
+    """
+    cards = [(deck, card) for deck, deck_cards in cards_by_deck.items() for card in deck_cards]
+    if not threshold or len(cards) < 2:
+        return OrderedDict(cards_by_deck), 0
+
+    parent = list(range(len(cards)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        i, j = find(i), find(j)
+        if i != j:
+            # La raíz es siempre la primera tarjeta del grupo
+            parent[max(i, j)] = min(i, j)
+
+    # Texto idéntico tras normalizar; sin palabras (p. ej. sólo letras griegas
+    # o símbolos) no hay nada que comparar y la tarjeta se conserva
+    words = [card_words(question + " " + answer) for _, (question, answer) in cards]
+    first_seen = {}
+    for i, card_text in enumerate(words):
+        if not card_text:
+            continue
+        key = " ".join(card_text)
+        if key in first_seen:
+            union(first_seen[key], i)
+        else:
+            first_seen[key] = i
+
+    # Casi iguales: cada tarjeta es el conjunto de sus pares de palabras
+    # consecutivas (la primera con un inicio ficticio, 0), codificados como
+    # enteros de 32 bits. Los candidatos salen de LSH y se confirman con la
+    # similitud de Jaccard exacta.
+    candidates = list(first_seen.values())
+    if len(candidates) > 1:
+        flat = [word for i in candidates for word in words[i]]
+        vocabulary = {word: n for n, word in enumerate(dict.fromkeys(flat), 1)}
+        ids = np.fromiter(map(vocabulary.__getitem__, flat), dtype=np.uint64, count=len(flat))
+        starts = np.cumsum([0] + [len(words[i]) for i in candidates[:-1]])
+        previous = np.roll(ids, 1)
+        previous[starts] = 0
+        shingles = (previous * np.uint64(2654435761) + ids) % np.uint64(1 << 32)
+        bounds = np.append(starts, len(shingles))
+        sets = {}
+
+        def shingle_set(n):
+            if n not in sets:
+                sets[n] = set(shingles[bounds[n]:bounds[n + 1]].tolist())
+            return sets[n]
+
+        signatures = MinHasher(DEDUP_BANDS * DEDUP_ROWS).signatures(shingles, starts)
+        for members in lsh_buckets(signatures, DEDUP_BANDS, DEDUP_ROWS):
+            for x, n in enumerate(members[1:], 1):
+                for m in members[:x]:
+                    i, j = candidates[m], candidates[n]
+                    if find(i) == find(j):
+                        continue
+                    a, b = shingle_set(m), shingle_set(n)
+                    if len(a & b) >= threshold * len(a | b):
+                        union(i, j)
+
+    groups = OrderedDict()
+    for i in range(len(cards)):
+        groups.setdefault(find(i), []).append(i)
+    deduplicated = OrderedDict()
+    for root, members in groups.items():
+        deck, (question, answer) = cards[root]
+        if len(members) > 1:
+            answer = max((cards[i][1][1] for i in members), key=lambda text: len(card_words(text)))
+        deduplicated.setdefault(deck, []).append((question, answer))
+    return deduplicated, len(cards) - len(groups)
+
+
+def deck_root(name):
+    """Mazo de primer nivel de un nombre jerárquico (``Padre::Hijo`` -> ``Padre``)."""
+    return name.partition('::')[0].strip()
+
+
+def deck_vectors(decks):
+    """Vectores TF-IDF de ``(nombre, tarjetas)`` (una fila de norma 1 por mazo)."""
+    documents = []
+    for name, cards in decks:
+        words = card_words(name.replace('::', ' ')) * DECK_NAME_WEIGHT
+        for question, answer in cards:
+            words.extend(card_words(question + " " + answer))
+        documents.append(Counter(words))
+    frequency = Counter(term for document in documents for term in document)
+    terms = {term: n for n, (term, _) in enumerate(frequency.most_common(DECK_FEATURES))}
+    rows, columns, counts = [], [], []
+    for row, document in enumerate(documents):
+        for term, count in document.items():
+            if term in terms:
+                rows.append(row)
+                columns.append(terms[term])
+                counts.append(count)
+    vectors = np.zeros((len(documents), len(terms)), dtype=np.float32)
+    vectors[rows, columns] = 1 + np.log(np.array(counts, dtype=np.float32))
+    # IDF suavizado: los términos presentes en todos los mazos pesan poco
+    present = np.array([frequency[term] for term in terms], dtype=np.float32)
+    vectors *= np.log((1 + len(documents)) / (1 + present)) + 1
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+def consolidate_decks(cards_by_deck, max_decks=MAX_DECKS):
+    """Agrupa los mazos por tema hasta dejar como mucho ``max_decks`` de primer nivel.
+
+    Los mazos con el mismo padre (``Padre::Hijo``) forman una unidad. Las
+    unidades se agrupan de forma aglomerativa por enlace promedio: en cada
+    paso se unen los dos grupos más parecidos (TF-IDF de nombres y tarjetas,
+    con un extra para los cercanos en el documento). Cada grupo toma el
+    nombre de su unidad con más tarjetas y el resto de sus mazos quedan
+    debajo como submazos (``Grupo::Original``), de modo que ningún nombre se
+    pierde ni se repite. Los grupos siguen el orden de su primer mazo y las
+    tarjetas conservan el suyo.
+    """
+    units = OrderedDict()
+    for deck in cards_by_deck:
+        units.setdefault(deck_root(deck), []).append(deck)
+    count = len(units)
+    if count <= max_decks:
         return OrderedDict(cards_by_deck)
 
-    trimmed = OrderedDict()
-    extras = []
-    inserted_general = False
-    for i, (name, cards) in enumerate(cards_by_deck.items()):
-        if i < max_decks - 1:
-            trimmed[name] = cards
+    roots = list(units)
+    vectors = deck_vectors(
+        (" ".join(decks), [card for deck in decks for card in cards_by_deck[deck]])
+        for decks in units.values()
+    )
+    positions = np.arange(count)
+
+    def bonus(i):
+        return DECK_ORDER_WEIGHT * (1 - np.abs(positions - i) / count)
+
+    # Similitud media entre grupos (enlace promedio); ``score`` le suma el extra
+    similarity = (vectors @ vectors.T).astype(np.float64)
+    score = similarity + np.array([bonus(i) for i in range(count)])
+    np.fill_diagonal(score, -np.inf)
+    members = {i: [i] for i in range(count)}
+    # Mejor vecino de cada grupo, para no recorrer toda la matriz en cada paso
+    nearest = score.argmax(axis=1)
+    best = score[positions, nearest]
+
+    for _ in range(count - max(max_decks, 1)):
+        i = int(best.argmax())
+        j = int(nearest[i])
+        # El grupo resultante se queda en la posición del primero
+        i, j = min(i, j), max(i, j)
+        size_i, size_j = len(members[i]), len(members[j])
+        members[i].extend(members.pop(j))
+        similarity[i] = similarity[:, i] = (size_i * similarity[i] + size_j * similarity[j]) / (size_i + size_j)
+        row = similarity[i] + bonus(i)
+        row[~np.isfinite(score[i])] = -np.inf
+        row[i] = row[j] = -np.inf
+        score[i] = score[:, i] = row
+        score[j] = score[:, j] = -np.inf
+        best[j] = -np.inf
+        # Los que apuntaban a i o j se recalculan; el resto sólo compara con i
+        stale = np.flatnonzero(((nearest == i) | (nearest == j)) & np.isfinite(best))
+        nearest[stale] = score[stale].argmax(axis=1)
+        best[stale] = score[stale, nearest[stale]]
+        closer = row > best
+        nearest[closer] = i
+        best[closer] = row[closer]
+        nearest[i] = int(row.argmax())
+        best[i] = row[nearest[i]]
+
+    def unit_size(k):
+        return sum(len(cards_by_deck[deck]) for deck in units[roots[k]])
+
+    order = {deck: n for n, deck in enumerate(cards_by_deck)}
+    consolidated = OrderedDict()
+    for i in sorted(members):
+        group = sorted(members[i])
+        # La unidad con más tarjetas da nombre al grupo; "General" sólo si no hay otra
+        top = roots[max(group, key=lambda k: (roots[k] != 'General', unit_size(k), -k))]
+        decks = sorted(
+            (deck for k in group for deck in units[roots[k]]),
+            key=order.__getitem__,
+        )
+        # Los mazos de la unidad principal conservan su nombre; los demás pasan
+        # a ``top::mazo`` con un sufijo numérico si ese submazo ya existe
+        kept = {deck for deck in decks if deck_root(deck) == top}
+        for deck in decks:
+            name = deck
+            if deck not in kept:
+                name = base = f"{top}::{deck}"
+                suffix = 2
+                while name in kept or name in consolidated:
+                    name = f"{base} ({suffix})"
+                    suffix += 1
+            consolidated[name] = list(cards_by_deck[deck])
+    return consolidated
+
+
+def estimate_tokens(text):
+    """Estimación rápida de tokens: palabras y signos, con un margen para subpalabras."""
+    return int(len(TOKEN_PATTERN.findall(text)) * TOKENS_PER_WORD) + 1
+
+
+def chunk_token_budget():
+    """Tokens de texto por fragmento según el contexto del modelo configurado.
+
+    Del contexto se descuenta el ``SYSTEM_PROMPT`` y un margen para el
+    resumen de encabezados; del resto sólo se usa ``CHUNK_CONTEXT_FRACTION``
+    para dejar sitio a la respuesta. El historial conversacional se recorta
+    en ``context_messages`` para que todo quepa en el contexto.
+    """
+    if CHUNK_MAX_TOKENS:
+        return CHUNK_MAX_TOKENS
+    available = MODEL_CONTEXT_TOKENS - estimate_tokens(SYSTEM_PROMPT) - 256
+    return max(256, int(available * CHUNK_CONTEXT_FRACTION))
+
+
+def _is_heading(text):
+    return len(text) <= 80 and TEXT_HEADING_PATTERN.match(text) is not None
+
+
+def _text_lines(pieces, max_chars):
+    """Líneas completas de ``pieces``; una línea puede continuar en el trozo siguiente.
+
+    Las líneas de más de ``max_chars`` sin saltos se cortan en un espacio,
+    para no acumular el documento entero si no tiene saltos de línea.
+    """
+    tail = ""
+    for piece in pieces:
+        lines = (tail + piece).split('\n')
+        tail = lines.pop()
+        if len(tail) > max_chars:
+            cut = tail.rfind(' ')
+            if cut > 0:
+                lines.append(tail[:cut])
+                tail = tail[cut + 1:]
+        yield from lines
+    yield tail
+
+
+def iter_text_units(pieces, max_tokens):
+    """Genera las unidades de troceo a medida que llega el texto.
+
+    ``pieces`` es un iterable de trozos consecutivos del documento (por
+    ejemplo, páginas). El texto se recorre línea a línea: el bloque en curso
+    se cierra en cada línea en blanco, antes de cada línea que parece un
+    encabezado (que es una unidad propia) y cuando superaría ``max_tokens``,
+    sin esperar al final del párrafo. Un bloque que aun así supera
+    ``max_tokens`` se divide en frases. Cada unidad es ``(texto, separador)``.
+    """
+    block = []
+    block_tokens = 0
+
+    def flush(sep):
+        nonlocal block_tokens
+        text = "\n".join(block).strip()
+        block.clear()
+        block_tokens = 0
+        if not text:
+            return []
+        if estimate_tokens(text) > max_tokens:
+            sentences = re.split(r'(?<=[.!?])\s+', text)
+            return [(sent, " ") for sent in sentences[:-1]] + [(sentences[-1], sep)]
+        return [(text, sep)]
+
+    # Unos 4 caracteres por token bastan para no cortar líneas normales
+    for line in _text_lines(pieces, max_tokens * 4):
+        stripped = line.strip()
+        if not stripped:
+            yield from flush("\n\n")
+        elif _is_heading(stripped):
+            yield from flush("\n\n")
+            yield stripped, "\n\n"
         else:
-            extras.extend(cards)
-            if not inserted_general:
-                trimmed['General'] = []
-                inserted_general = True
-
-    trimmed['General'].extend(extras)
-    return trimmed
-
-def dividir_texto(texto, max_chars=1500):
-    """Divide el texto en fragmentos procurando no cortar oraciones."""
-    logger.info(f"Dividiendo texto de {len(texto)} caracteres en fragmentos de máximo {max_chars}")
-    progress_data['debug'] = f"Dividiendo texto en fragmentos de máximo {max_chars} caracteres"
+            tokens = estimate_tokens(line)
+            if block and block_tokens + tokens > max_tokens:
+                # Párrafo largo: se entrega lo acumulado y se sigue en el mismo párrafo
+                yield from flush("\n")
+            block.append(line)
+            block_tokens += tokens
+    yield from flush("\n\n")
+
+
+def _unit_hash(unit):
+    return hashlib.blake2b((unit[1] + unit[0]).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _join_units(group):
+    return "".join(text + sep for (text, sep), _, _ in group).strip()
+
+
+def iter_chunks(units, previous=(), max_tokens=None):
+    """Agrupa unidades en fragmentos de como máximo ``max_tokens`` a medida que llegan.
+
+    Un encabezado abre un fragmento nuevo si el actual ya ocupa al menos
+    ``CHUNK_MIN_FILL`` del presupuesto, y nunca queda como última unidad de un
+    fragmento.
+
+    Si se pasa ``previous`` (fragmentos de una versión anterior), un fragmento
+    anterior se reutiliza cuando su secuencia de unidades, comparada por hash,
+    aparece intacta en el texto nuevo. El resto de unidades se agrupan de forma
+    voraz, de modo que una inserción no desplaza los límites de los fragmentos
+    posteriores.
+
+    Genera tuplas ``(fragmento, tarjetas_reutilizadas, hashes_de_unidad)``;
+    las tarjetas son ``None`` si el fragmento hay que generarlo.
+    """
+    if max_tokens is None:
+        max_tokens = chunk_token_budget()
+    starts = {}
+    for entry in previous:
+        if entry['units']:
+            starts.setdefault(entry['units'][0], []).append(entry)
+    lookahead = max((len(entry['units']) for entry in previous), default=1)
+
+    units = iter(units)
+    buffer = deque()
+    current = []
+    length = 0
+
+    def cut(carry_headings=True):
+        """Cierra el fragmento actual; los encabezados finales pasan al siguiente."""
+        carry = []
+        while carry_headings and len(current) > 1 and _is_heading(current[-1][0][0]):
+            carry.append(current.pop())
+        chunk = (_join_units(current), None, [h for _, h, _ in current])
+        current[:] = carry[::-1]
+        return chunk
+
+    while True:
+        while len(buffer) < lookahead:
+            unit = next(units, None)
+            if unit is None:
+                break
+            buffer.append((unit, _unit_hash(unit), estimate_tokens(unit[0])))
+        if not buffer:
+            break
+
+        match = None
+        for entry in starts.get(buffer[0][1], ()):
+            n = len(entry['units'])
+            if n <= len(buffer) and all(buffer[k][1] == entry['units'][k] for k in range(n)):
+                match = entry
+                break
+        if match is not None:
+            if current:
+                yield cut(carry_headings=False)
+            length = 0
+            group = [buffer.popleft() for _ in match['units']]
+            yield _join_units(group), match['cards'], [h for _, h, _ in group]
+            continue
+
+        item = buffer.popleft()
+        size = item[2]
+        full = length + size > max_tokens
+        if current and (full or (_is_heading(item[0][0]) and length >= max_tokens * CHUNK_MIN_FILL)):
+            yield cut()
+            length = sum(tokens for _, _, tokens in current)
+        current.append(item)
+        length += size
+    if current:
+        yield cut(carry_headings=False)
+
+
+def _version_path(name):
+    return os.path.join(VERSIONS_FOLDER, hashlib.sha256(name.encode('utf-8')).hexdigest() + '.json')
+
+
+def load_previous_version(name):
+    """Carga los fragmentos y tarjetas de la última versión procesada de un documento."""
+    path = _version_path(name)
+    if not os.path.exists(path):
+        return []
     try:
-        chunks = []
-        current_chunk = ""
-
-        paragraphs = [p.strip() for p in texto.split('\n\n') if p.strip()]
-
-        for para in paragraphs:
-            if len(para) > max_chars:
-                sentences = re.split(r'(?<=[.!?])\s+', para)
-                for sent in sentences:
-                    if len(current_chunk) + len(sent) + 1 > max_chars:
-                        if current_chunk.strip():
-                            chunks.append(current_chunk.strip())
-                            current_chunk = ""
-                    current_chunk += sent + " "
-            else:
-                if len(current_chunk) + len(para) + 2 > max_chars:
-                    if current_chunk.strip():
-                        chunks.append(current_chunk.strip())
-                        current_chunk = ""
-                current_chunk += para + "\n\n"
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return [
+            {
+                'units': entry['units'],
+                'cards': OrderedDict(
+                    (deck, [tuple(card) for card in cards]) for deck, cards in entry['cards'].items()
+                ),
+            }
+            for entry in data['chunks']
+        ]
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"No se pudo leer la versión anterior de {name}: {e}")
+        return []
 
-        if current_chunk.strip():
-            chunks.append(current_chunk.strip())
 
-        logger.info(f"Texto dividido en {len(chunks)} fragmentos")
-        progress_data['debug'] = f"Texto dividido en {len(chunks)} fragmentos"
-        return chunks
+def save_version(name, chunk_units, chunk_cards):
+    """Guarda los fragmentos y tarjetas de un documento para futuras versiones.
+
+    Los fragmentos sin tarjetas no se guardan, así se regeneran la próxima vez.
+    """
+    path = _version_path(name)
+    data = {
+        'name': name,
+        'saved_at': time.time(),
+        'chunks': [
+            {'units': units, 'cards': cards}
+            for units, cards in zip(chunk_units, chunk_cards)
+            if any(cards.values())
+        ],
+    }
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def coverage_terms(text):
+    """Términos de un texto para medir cobertura.
+
+    Se quitan etiquetas HTML, acentos y palabras vacías, y cada palabra se
+    recorta a sus seis primeras letras como raíz aproximada.
+    """
+    text = unicodedata.normalize('NFKD', HTML_TAG_PATTERN.sub(' ', text).lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return {word[:6] for word in COVERAGE_WORD_PATTERN.findall(text) if word not in COVERAGE_STOPWORDS}
 
-    except Exception as e:
-        logger.error(f"Error al dividir texto: {e}")
-        progress_data['debug'] = f"Error al dividir texto: {e}"
-        raise
 
+def split_sentences(text):
+    return [s.strip() for s in SENTENCE_SPLIT_PATTERN.split(text) if s.strip()]
 
-def quality_check(chunks, cards_by_deck):
-    """Comprueba que cada fragmento tenga al menos una tarjeta asociada."""
-    import difflib
 
-    all_cards = [
-        (q.lower() + " " + a.lower())
+def coverage_report(chunks, cards_by_deck):
+    """Mide qué parte de cada fragmento está cubierta por las tarjetas.
+
+    Frases y tarjetas se tokenizan una sola vez y las tarjetas se indexan por
+    término. La puntuación de una frase es la mayor fracción de su peso IDF
+    presente en una misma tarjeta; sólo se comparan las tarjetas que comparten
+    alguno de sus términos más raros, de modo que el coste crece con el texto
+    y no con frases × tarjetas. Las frases con menos de
+    ``COVERAGE_MIN_TERMS`` términos no puntúan.
+
+    Devuelve por fragmento un dict con su número, la fracción de frases
+    cubiertas, la puntuación de cada frase (``None`` si no puntúa) y las frases
+    sin cubrir.
+    """
+    card_terms = [
+        coverage_terms(q + ' ' + a)
         for cards in cards_by_deck.values()
         for q, a in cards
     ]
-    missing = []
-    for i, chunk in enumerate(chunks):
-        snippet = chunk.strip()[:80].lower()
-        found = any(difflib.SequenceMatcher(None, snippet, text).ratio() > 0.2 for text in all_cards)
-        if not found:
-            missing.append(i + 1)
-    return missing
+    index = {}
+    for card_id, terms in enumerate(card_terms):
+        for term in terms:
+            index.setdefault(term, []).append(card_id)
+
+    sentences = [[(s, coverage_terms(s)) for s in split_sentences(chunk)] for chunk in chunks]
+    df = Counter(term for chunk in sentences for _, terms in chunk for term in terms)
+    n_sentences = sum(len(chunk) for chunk in sentences)
+    idf = {term: math.log(1 + n_sentences / count) for term, count in df.items()}
+
+    report = []
+    for n, chunk in enumerate(sentences, 1):
+        scores = []
+        uncovered = []
+        for sentence, terms in chunk:
+            if len(terms) < COVERAGE_MIN_TERMS:
+                scores.append(None)
+                continue
+            weight = sum(idf[t] for t in terms)
+            rarest = sorted((t for t in terms if t in index), key=idf.get, reverse=True)[:3]
+            candidates = {card_id for t in rarest for card_id in index[t]}
+            best = max((sum(idf[t] for t in terms & card_terms[c]) for c in candidates), default=0.0)
+            score = best / weight
+            scores.append(round(score, 3))
+            if score < COVERAGE_SENTENCE_MIN:
+                uncovered.append(sentence)
+        scored = sum(score is not None for score in scores)
+        report.append({
+            'chunk': n,
+            'coverage': (scored - len(uncovered)) / scored if scored else 1.0,
+            'scores': scores,
+            'uncovered': uncovered,
+        })
+    return report
+
+
+def chunk_label(indices):
+    """Números de fragmento de un lote para los mensajes: ``3`` o ``3-5``."""
+    if len(indices) == 1:
+        return str(indices[0] + 1)
+    return f"{indices[0] + 1}-{indices[-1] + 1}"
+
+
+def batch_chunks(planned):
+    """Agrupa fragmentos nuevos consecutivos en lotes para enviarlos juntos.
+
+    Genera tuplas ``(índices, fragmentos, tarjetas_reutilizadas)``. Un lote
+    reúne como mucho ``BATCH_MAX_CHUNKS`` fragmentos y ``BATCH_MAX_TOKENS``
+    de texto; los reutilizados se entregan siempre solos. Sin
+    ``BATCH_CHUNKS`` cada fragmento forma su propio lote.
+    """
+    budget = BATCH_MAX_TOKENS or 2 * chunk_token_budget()
+    indices, texts, tokens = [], [], 0
+    for i, chunk, reused_cards in planned:
+        size = estimate_tokens(chunk)
+        if indices and (
+            reused_cards is not None
+            or not BATCH_CHUNKS
+            or len(indices) >= BATCH_MAX_CHUNKS
+            or tokens + size > budget
+        ):
+            yield indices, texts, None
+            indices, texts, tokens = [], [], 0
+        if reused_cards is not None:
+            yield [i], [chunk], reused_cards
+            continue
+        indices.append(i)
+        texts.append(chunk)
+        tokens += size
+    if indices:
+        yield indices, texts, None
+
+
+def batch_prompt(indices, texts):
+    """Texto que se envía al modelo para un lote de fragmentos."""
+    if len(indices) == 1:
+        return texts[0]
+    parts = [f"=== FRAGMENTO {i + 1} ===\n{text}" for i, text in zip(indices, texts)]
+    return (BATCH_JSON_PROMPT if LLM_JSON_OUTPUT else BATCH_PROMPT) + "\n\n" + "\n\n".join(parts)
+
+
+def generate_batch(job, indices, texts, call, prefix=""):
+    """Genera las tarjetas de un lote con ``call(prompt, card_stream)``.
+
+    Devuelve las tarjetas de cada fragmento del lote en orden. Los fragmentos
+    a los que el modelo no atribuye ninguna tarjeta se envían de nuevo por
+    separado.
+    """
+    card_stream = CardStream(job, indices) if LLM_STREAM and not LLM_JSON_OUTPUT else None
+    output = call(prefix + batch_prompt(indices, texts), card_stream)
+    if len(indices) == 1:
+        return [parse_reply(output, job)]
+    by_chunk = parse_reply(output, job, indices)
+    batch_cards = []
+    for i, text in zip(indices, texts):
+        partial_cards = by_chunk[i]
+        if not any(partial_cards.values()):
+            logger.warning(f"Fragmento {i+1} sin tarjetas en el lote; se envía por separado")
+            job.update(debug=f"Reenviando fragmento {i+1} por separado")
+            partial_cards = generate_batch(job, [i], [text], call, prefix)[0]
+        batch_cards.append(partial_cards)
+    return batch_cards
+
+
+async def generate_batch_async(job, indices, texts, call, prefix=""):
+    """Versión asyncio de ``generate_batch``."""
+    card_stream = CardStream(job, indices) if LLM_STREAM and not LLM_JSON_OUTPUT else None
+    output = await call(prefix + batch_prompt(indices, texts), card_stream)
+    if len(indices) == 1:
+        return [parse_reply(output, job)]
+    by_chunk = parse_reply(output, job, indices)
+    batch_cards = []
+    for i, text in zip(indices, texts):
+        partial_cards = by_chunk[i]
+        if not any(partial_cards.values()):
+            logger.warning(f"Fragmento {i+1} sin tarjetas en el lote; se envía por separado")
+            job.update(debug=f"Reenviando fragmento {i+1} por separado")
+            partial_cards = (await generate_batch_async(job, [i], [text], call, prefix))[0]
+        batch_cards.append(partial_cards)
+    return batch_cards
+
+
+def generate_sequential(planned, job):
+    """Envía los fragmentos uno a uno compartiendo el historial conversacional.
+
+    ``planned`` genera tuplas ``(índice, fragmento, tarjetas_reutilizadas)``;
+    los fragmentos reutilizados no se envían al modelo y aportan sus tarjetas
+    tal cual. Con ``BATCH_CHUNKS`` los fragmentos se envían por lotes.
+    Devuelve las tarjetas de cada fragmento en orden.
+    """
+    first = True
+
+    def call(prompt, card_stream):
+        nonlocal first
+        if first:
+            first = False
+            return call_phi3(prompt, job, reset=True, system_prompt=SYSTEM_PROMPT, card_stream=card_stream)
+        return call_phi3(prompt, job, card_stream=card_stream)
+
+    with ChunkResults(job) as results:
+        for indices, texts, reused_cards in batch_chunks(planned):
+            if reused_cards is not None:
+                results.put(indices[0], texts[0], reused_cards, reused=True)
+                continue
+            label = chunk_label(indices)
+            logger.info(f"Enviando fragmento {label} a la API")
+            job.update(debug=f"Enviando fragmento {label}/{job.total} al modelo")
+            try:
+                batch_cards = generate_batch(job, indices, texts, call)
+            except Exception as e:
+                logger.error(f"Error procesando fragmento {label}: {e}")
+                job.update(debug=f"Error procesando fragmento {label}: {e}")
+                raise
+            for i, text, partial_cards in zip(indices, texts, batch_cards):
+                results.put(i, text, partial_cards)
+                logger.info(f"Fragmento {i+1} procesado exitosamente")
+        return results.wait()
+
+
+def chunk_headings(chunk):
+    """Encabezados que aparecen en el texto de un fragmento."""
+    headings = []
+    for line in chunk.split('\n'):
+        line = line.strip()
+        if len(line) <= 80 and TEXT_HEADING_PATTERN.match(line):
+            headings.append(line.rstrip(':'))
+    return headings
+
+
+def headings_digest(headings, max_headings=8):
+    """Resumen de los últimos encabezados vistos, para anteponer al fragmento."""
+    recent = headings[-max_headings:]
+    if not recent:
+        return ""
+    return "Encabezados previos del documento: " + "; ".join(recent) + "\n\n"
+
+
+def repair_chunk(job, i, chunk, cards_by_deck, sentences, budget):
+    """Vuelve a pedir tarjetas para las frases de un fragmento que quedaron sin cubrir.
+
+    Las frases se agrupan en subfragmentos pequeños y cada uno se envía con
+    ``REPAIR_PROMPT`` y un historial propio, mientras quede ``budget``.
+    Devuelve las tarjetas del fragmento con las nuevas añadidas al final.
+    """
+    max_tokens = REPAIR_CHUNK_TOKENS or max(64, chunk_token_budget() // 4)
+    groups = [[]]
+    tokens = 0
+    for sentence in sentences:
+        size = estimate_tokens(sentence)
+        if groups[-1] and tokens + size > max_tokens:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(sentence)
+        tokens += size
+
+    repaired = OrderedDict((deck, list(cards)) for deck, cards in cards_by_deck.items())
+    for n, group in enumerate(groups, 1):
+        if not budget.take():
+            logger.warning(f"Presupuesto de reparación agotado en el fragmento {i+1}")
+            job.update(debug=f"Presupuesto de reparación agotado en el fragmento {i+1}")
+            break
+        logger.info(f"Reparando fragmento {i+1} ({n}/{len(groups)})")
+        job.update(debug=f"Reparando fragmento {i+1} ({n}/{len(groups)})")
+        history = [{"role": "system", "content": SYSTEM_PROMPT}]
+        try:
+            reply = call_phi3(REPAIR_PROMPT + "\n\n" + "\n".join(group), job, history=history)
+        except Exception as e:
+            logger.error(f"Error reparando fragmento {i+1}: {e}")
+            continue
+        for deck, cards in parse_reply(reply, job).items():
+            repaired.setdefault(deck, []).extend(cards)
+    return repaired
+
+
+class RepairBudget:
+    """Número de peticiones de reparación que aún puede hacer un trabajo."""
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class ChunkResults:
+    """Incorpora al trabajo las tarjetas de cada fragmento en el orden del documento.
+
+    Un fragmento sólo se añade cuando todos los anteriores se han añadido.
+    Los fragmentos nuevos sin tarjetas o con menos de ``COVERAGE_CHUNK_MIN``
+    de sus frases cubiertas se reparan en segundo plano (``repair_chunk``)
+    mientras sigue la generación del resto; su posición queda reservada
+    hasta que la reparación termina.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.chunk_cards = []
+        self.pending = {}
+        self.budget = RepairBudget(REPAIR_BUDGET)
+        self.repairs = ThreadPoolExecutor(
+            max_workers=llm_backends.capacity(), thread_name_prefix=f"repair-{job.id[:8]}"
+        )
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.repairs.shutdown(wait=exc_type is None, cancel_futures=True)
+
+    def put(self, i, chunk, cards_by_deck, reused=False):
+        """Registra el resultado del fragmento ``i`` y lo repara si hace falta."""
+        sentences = None
+        if not reused and REPAIR_BUDGET:
+            if not any(cards_by_deck.values()):
+                sentences = split_sentences(chunk)
+            else:
+                with stage_timer(self.job, 'coverage'):
+                    report = coverage_report([chunk], cards_by_deck)[0]
+                if report['coverage'] < COVERAGE_CHUNK_MIN:
+                    sentences = report['uncovered']
+        if sentences:
+            logger.info(f"Fragmento {i+1} con cobertura insuficiente; se repara en segundo plano")
+            future = self.repairs.submit(self._repair, i, chunk, cards_by_deck, sentences)
+            self.job.count_repair()
+        else:
+            future = Future()
+            future.set_result(cards_by_deck)
+        with self._lock:
+            self.pending[i] = future
+        future.add_done_callback(lambda _: self.flush())
+
+    def _repair(self, i, chunk, cards_by_deck, sentences):
+        try:
+            return repair_chunk(self.job, i, chunk, cards_by_deck, sentences, self.budget)
+        except Exception as e:
+            logger.error(f"Error reparando fragmento {i+1}: {e}")
+            return cards_by_deck
+
+    def flush(self):
+        with self._lock:
+            while len(self.chunk_cards) in self.pending:
+                i = len(self.chunk_cards)
+                future = self.pending[i]
+                if not future.done() or future.cancelled():
+                    break
+                del self.pending[i]
+                partial_cards = future.result()
+                if not any(partial_cards.values()):
+                    logger.warning(f"Fragmento {i+1} no generó tarjetas")
+                    self.job.update(debug=f"Fragmento {i+1} sin tarjetas")
+                self.job.add_cards(partial_cards, chunk=i)
+                self.chunk_cards.append(partial_cards)
+            self.job.update(current=len(self.chunk_cards))
+
+    def wait(self):
+        """Espera a las reparaciones pendientes y devuelve las tarjetas de cada fragmento."""
+        with self._lock:
+            futures = list(self.pending.values())
+        wait_futures(futures)
+        self.flush()
+        return self.chunk_cards
+
+
+def generate_independent(planned, job):
+    """Genera los fragmentos en paralelo, cada uno con un historial propio.
+
+    Cada fragmento (o lote, con ``BATCH_CHUNKS``) se encola en cuanto
+    ``planned`` lo produce, con como mucho ``capacity`` lotes pendientes, y
+    pasa a ``ChunkResults`` en cuanto termina. Los resultados se incorporan al trabajo en el
+    orden del documento: un fragmento sólo se añade cuando todos los
+    anteriores han terminado. Devuelve las tarjetas de cada fragmento en orden.
+    """
+    if LLM_ASYNC and httpx is not None:
+        return asyncio.run(generate_independent_async(planned, job))
+
+    headings = []
+
+    def call(prompt, card_stream):
+        history = [{"role": "system", "content": SYSTEM_PROMPT}]
+        return call_phi3(prompt, job, history=history, card_stream=card_stream)
+
+    capacity = llm_backends.capacity()
+    logger.info(f"Generando fragmentos con hasta {capacity} en paralelo")
+    with ChunkResults(job) as results, \
+            ThreadPoolExecutor(max_workers=capacity, thread_name_prefix=f"chunk-{job.id[:8]}") as pool:
+        futures = {}
+
+        def collect(done):
+            # Cada lote terminado pasa a ``results`` en cuanto acaba
+            for future in done:
+                indices, texts = futures.pop(future)
+                try:
+                    batch_cards = future.result()
+                except Exception as e:
+                    logger.error(f"Error procesando fragmento {chunk_label(indices)}: {e}")
+                    job.update(debug=f"Error procesando fragmento {chunk_label(indices)}: {e}")
+                    raise
+                logger.info(f"Fragmento {chunk_label(indices)} procesado exitosamente")
+                for i, text, partial_cards in zip(indices, texts, batch_cards):
+                    results.put(i, text, partial_cards)
+
+        try:
+            for indices, texts, reused_cards in batch_chunks(planned):
+                if reused_cards is not None:
+                    results.put(indices[0], texts[0], reused_cards, reused=True)
+                else:
+                    # Como mucho ``capacity`` lotes encolados: el troceo espera al modelo
+                    if len(futures) >= capacity:
+                        collect(wait_futures(futures, return_when=FIRST_COMPLETED).done)
+                    prefix = headings_digest(headings) if HEADINGS_DIGEST else ""
+                    futures[pool.submit(generate_batch, job, indices, texts, call, prefix)] = (indices, texts)
+                for text in texts:
+                    headings.extend(chunk_headings(text))
+                collect([future for future in futures if future.done()])
+            while futures:
+                collect(wait_futures(futures, return_when=FIRST_COMPLETED).done)
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        return results.wait()
+
+
+async def generate_independent_async(planned, job):
+    """Versión asyncio de ``generate_independent`` (``LLM_ASYNC=1``).
+
+    Las peticiones se lanzan como tareas de un único bucle de eventos en lugar
+    de ocupar un hilo cada una; la extracción del texto sigue en un hilo.
+    """
+    headings = []
+    capacity = llm_backends.capacity()
+    in_flight = asyncio.Semaphore(capacity)
+    clients = {b: AsyncOllamaClient(b.url, b.max_concurrency) for b in llm_backends.backends}
+
+    async def call(prompt, card_stream):
+        history = [{"role": "system", "content": SYSTEM_PROMPT}]
+        return await call_phi3_async(clients, prompt, job, history=history, card_stream=card_stream)
+
+    async def generate(indices, texts, prefix):
+        # El hueco en ``in_flight`` se toma al crear la tarea
+        try:
+            batch_cards = await generate_batch_async(job, indices, texts, call, prefix)
+        except Exception as e:
+            logger.error(f"Error procesando fragmento {chunk_label(indices)}: {e}")
+            job.update(debug=f"Error procesando fragmento {chunk_label(indices)}: {e}")
+            raise
+        finally:
+            in_flight.release()
+        logger.info(f"Fragmento {chunk_label(indices)} procesado exitosamente")
+        for i, text, partial_cards in zip(indices, texts, batch_cards):
+            results.put(i, text, partial_cards)
+
+    logger.info(f"Generando fragmentos con hasta {capacity} en paralelo (asyncio)")
+    tasks = set()
+
+    def check_tasks():
+        # Olvida las tareas terminadas y propaga el primer error
+        for task in [task for task in tasks if task.done()]:
+            tasks.discard(task)
+            task.result()
+
+    results = ChunkResults(job)
+    try:
+        batches = batch_chunks(planned)
+        while True:
+            item = await asyncio.to_thread(next, batches, None)
+            if item is None:
+                break
+            indices, texts, reused_cards = item
+            if reused_cards is not None:
+                results.put(indices[0], texts[0], reused_cards, reused=True)
+            else:
+                # Como mucho ``capacity`` lotes pendientes: el troceo espera al modelo
+                await in_flight.acquire()
+                check_tasks()
+                prefix = headings_digest(headings) if HEADINGS_DIGEST else ""
+                tasks.add(asyncio.create_task(generate(indices, texts, prefix)))
+            for text in texts:
+                headings.extend(chunk_headings(text))
+        await asyncio.gather(*tasks)
+        return await asyncio.to_thread(results.wait)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for client in clients.values():
+            await client.aclose()
+        results.repairs.shutdown(wait=False, cancel_futures=True)
+
+
+def process_document(job, out_path=None):
+    """Ejecuta el pipeline completo y escribe el .apkg en ``out_path``.
+
+    El texto se extrae, se trocea y se envía al modelo en streaming: el primer
+    fragmento se genera mientras aún se extraen las páginas siguientes. Sin
+    ``out_path`` sólo se devuelven los mazos, sin crear el paquete.
+    """
+    previous = load_previous_version(job.filename) if INCREMENTAL_UPDATES else []
+    if previous:
+        job.update(debug="Comparando con la versión anterior del documento")
+    job.update(
+        total=0,
+        current=0,
+        status='processing',
+        message='Procesando archivo...',
+        partial_cards=OrderedDict(),
+    )
+    chunk_units = []
+    with ChunkStore(os.path.join(job_folder(job.id), 'chunks.txt')) as chunks:
+
+        def planned():
+            max_tokens = chunk_token_budget()
+            # Extracción y troceado avanzan a la par que la generación; se mide
+            # sólo el tiempo dedicado a cada uno
+            pieces = TimedIterator(iter_text(job.file_path, job))
+            planned_chunks = TimedIterator(iter_chunks(iter_text_units(pieces, max_tokens), previous, max_tokens))
+            reused = 0
+            for chunk, reused_cards, hashes in planned_chunks:
+                chunks.append(chunk)
+                chunk_units.append(hashes)
+                if reused_cards is not None:
+                    reused += 1
+                job.update(total=len(chunks), reused_chunks=reused)
+                yield len(chunks) - 1, chunk, reused_cards
+            logger.info(f"Texto dividido en {len(chunks)} fragmentos, {reused} reutilizados")
+            record_stage(job, 'extract', pieces.elapsed)
+            record_stage(job, 'split', planned_chunks.elapsed - pieces.elapsed)
+            if not chunks:
+                raise Exception("No se pudo extraer texto del archivo.")
+
+        with stage_timer(job, 'generate'):
+            if INDEPENDENT_CHUNKS:
+                chunk_cards = generate_independent(planned(), job)
+            else:
+                chunk_cards = generate_sequential(planned(), job)
+        flashcards_by_deck = job.cards()
+        with stage_timer(job, 'coverage'):
+            report = coverage_report(chunks, flashcards_by_deck)
+
+    if INCREMENTAL_UPDATES:
+        save_version(job.filename, chunk_units, chunk_cards)
+
+    missing_chunks = [i + 1 for i, cards in enumerate(chunk_cards) if not any(cards.values())]
+    total_cards = sum(len(cards) for cards in flashcards_by_deck.values())
+    if missing_chunks:
+        # Tras la reparación se conservan las tarjetas del resto del documento
+        logger.warning(f"Fragmentos sin tarjetas tras la reparación: {missing_chunks}")
+        job.update(debug=f"Fragmentos sin tarjetas: {missing_chunks}")
+    if total_cards == 0:
+        job.update(debug='Sin tarjetas generadas')
+        raise Exception("No se generaron flashcards a partir del texto.")
+
+    missing_after = [r['chunk'] for r in report if r['coverage'] < COVERAGE_CHUNK_MIN]
+    uncovered = [sentence for r in report for sentence in r['uncovered']]
+    scored = sum(score is not None for r in report for score in r['scores'])
+    job.update(coverage={
+        'ratio': round(1 - len(uncovered) / scored, 3) if scored else 1.0,
+        'uncovered_sentences': len(uncovered),
+        'chunks_below': missing_after,
+        'chunks_without_cards': missing_chunks,
+    })
+    if missing_after:
+        logger.warning(f"Fragmentos sin cobertura clara: {missing_after}")
+        job.update(debug=f"Faltan cubrir: {missing_after}")
+    for sentence in uncovered:
+        logger.debug(f"Frase sin cubrir: {sentence}")
+
+    logger.info(f"Tarjetas generadas: {total_cards} en total")
+    with stage_timer(job, 'dedup'):
+        flashcards_by_deck, merged = deduplicate_cards(flashcards_by_deck)
+    if merged:
+        logger.info(f"Tarjetas duplicadas fusionadas: {merged}")
+        job.update(debug=f"Tarjetas duplicadas fusionadas: {merged}")
+    metrics.inc('flashcards_merged_cards_total', merged)
+    job.update(merged_cards=merged)
+    decks = len({deck_root(deck) for deck in flashcards_by_deck})
+    with stage_timer(job, 'decks'):
+        flashcards_by_deck = consolidate_decks(flashcards_by_deck)
+    groups = len({deck_root(deck) for deck in flashcards_by_deck})
+    if groups < decks:
+        logger.info(f"Mazos agrupados por tema: {decks} -> {groups}")
+        job.update(debug=f"Mazos agrupados: {decks} -> {groups}")
+    job.update(partial_cards=flashcards_by_deck)
+    if out_path:
+        create_anki_apkg(flashcards_by_deck, out_path, job)
+        logger.info(f"Archivo .apkg disponible para descargar: {out_path}")
+        job.update(debug=f"Archivo .apkg creado: {os.path.basename(out_path)}")
+    return flashcards_by_deck
+
+
+def run_job(job):
+    """Procesa un trabajo encolado en uno de los workers del pool."""
+    job.update(status='processing', started_at=time.time())
+    try:
+        out_path = result_store.package_path(job.id)
+        flashcards_by_deck = process_document(job, out_path)
+        result_store.save(job, flashcards_by_deck)
+        job.update(
+            status='completed',
+            message='¡Tarjetas generadas!',
+            result_path=out_path,
+            total_cards=sum(len(cards) for cards in flashcards_by_deck.values()),
+        )
+        metrics.inc('flashcards_jobs_total', status='completed')
+        metrics.inc('flashcards_cards_total', job.total_cards)
+        logger.info(f"Trabajo {job.id} completado")
+    except Exception as e:
+        error = f"Error al procesar el archivo: {str(e)}"
+        job.update(status='error', message=error, error=error)
+        logger.error(error)
+        metrics.inc('flashcards_jobs_total', status='error')
+        result_store.discard(job.id)
+    finally:
+        # El historial ya no se usa y guarda textos completos de fragmentos
+        job.update(finished_at=time.time(), conversation_history=[])
+        record_stage(None, 'job', job.finished_at - job.started_at)
+        shutil.rmtree(job_folder(job.id), ignore_errors=True)
+        logger.info(f"Archivos temporales eliminados: {job.id}")
+
+
+def evict_jobs():
+    """Olvida los trabajos terminados hace más de ``JOBS_TTL_MINUTES``.
+
+    Se llama con ``jobs_lock`` tomado.
+    """
+    expired = time.time() - JOBS_TTL_MINUTES * 60
+    for job_id in [job_id for job_id, job in jobs.items() if job.finished_at and job.finished_at < expired]:
+        logger.info(f"Trabajo eliminado de memoria: {job_id}")
+        del jobs[job_id]
+
+
+def submit_job(file):
+    """Guarda el archivo subido en la carpeta del trabajo y encola su procesamiento.
+
+    Devuelve el ``JobState`` creado o ``None`` si la cola está llena. Lanza
+    ``UploadTooLarge`` si el archivo supera el límite de tamaño.
+    """
+    name, ext = os.path.splitext(os.path.basename(file.filename))
+    with jobs_lock:
+        evict_jobs()
+        queued = sum(1 for job in jobs.values() if job.status == 'queued')
+        if queued >= MAX_QUEUED_JOBS:
+            return None
+        job_id = uuid.uuid4().hex
+        file_path = os.path.join(job_folder(job_id), f"source{ext.lower()}")
+        job = JobState(job_id, name, file_path)
+        jobs[job_id] = job
+    try:
+        with stage_timer(job, 'upload'):
+            spool_upload(file, file_path)
+    except Exception:
+        with jobs_lock:
+            jobs.pop(job_id, None)
+        shutil.rmtree(job_folder(job_id), ignore_errors=True)
+        raise
+    logger.info(f"Archivo guardado: {file_path}")
+    job.update(debug=f"Archivo guardado: {os.path.basename(file_path)}")
+    job_executor.submit(run_job, job)
+    return job
 
 
 @app.route("/", methods=["GET", "POST"])
 def index():
-    """Ruta principal para la interfaz y procesamiento de archivos."""
-    flashcards_by_deck = OrderedDict()
-    download_url = None
+    """Ruta principal para la interfaz y encolado de archivos."""
     error = None
+    job = None
+    file = None
 
     if request.method == "POST":
         file = request.files.get('file')
+        wants_json = request.accept_mimetypes.best == 'application/json'
         if not file:
             error = "No se seleccionó ningún archivo."
             logger.error(error)
-            progress_data['status'] = 'error'
-            progress_data['message'] = error
-            progress_data['debug'] = error
+            if wants_json:
+                return jsonify({'error': error}), 400
         else:
-            filename = os.path.splitext(file.filename)[0]
-            file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-            file.save(file_path)
-            logger.info(f"Archivo guardado: {file_path}")
-            progress_data['debug'] = f"Archivo guardado: {os.path.basename(file_path)}"
-
             try:
-                content = extract_text(file_path)
-                if not content.strip():
-                    error = "No se pudo extraer texto del archivo."
-                    logger.error(error)
-                    progress_data['status'] = 'error'
-                    progress_data['message'] = error
-                    progress_data['debug'] = error
+                job = submit_job(file)
+            except UploadTooLarge as e:
+                error = str(e)
+                logger.warning(error)
+                if wants_json:
+                    return jsonify({'error': error}), 413
+            else:
+                if job is None:
+                    error = "Hay demasiados archivos en cola. Inténtalo de nuevo más tarde."
+                    logger.warning(error)
+                    if wants_json:
+                        return jsonify({'error': error}), 503
                 else:
-                    chunks = dividir_texto(content)
-                    progress_data['total'] = len(chunks)
-                    progress_data['current'] = 0
-                    progress_data['status'] = 'processing'
-                    progress_data['message'] = 'Procesando archivo...'
-                    progress_data['partial_cards'] = {}
-                    logger.info(f"Procesando {len(chunks)} fragmentos de texto")
-
-                    missing_chunks = []
-
-                    for i, chunk in enumerate(chunks):
-                        logger.info(f"Enviando fragmento {i+1}/{len(chunks)} a la API")
-                        progress_data['debug'] = f"Enviando fragmento {i+1}/{len(chunks)} al modelo"
-                        try:
-                            if i == 0:
-                                ai_output = call_phi3(chunk, reset=True, system_prompt=PROMPT)
-                            else:
-                                ai_output = call_phi3(chunk)
-                            partial_cards = parse_phi3_output(ai_output)
-                            if not any(partial_cards.values()):
-                                logger.warning(f"Fragmento {i+1} no generó tarjetas")
-                                progress_data['debug'] = f"Fragmento {i+1} sin tarjetas"
-                                missing_chunks.append(i + 1)
-                            for deck, cards in partial_cards.items():
-                                flashcards_by_deck.setdefault(deck, []).extend(cards)
-                            progress_data['partial_cards'] = flashcards_by_deck
-                            progress_data['current'] = i + 1
-                            logger.info(f"Fragmento {i+1} procesado exitosamente")
-                        except Exception as e:
-                            logger.error(f"Error procesando fragmento {i+1}: {e}")
-                            progress_data['debug'] = f"Error procesando fragmento {i+1}: {e}"
-                            raise
-
-                    total_cards = sum(len(cards) for cards in flashcards_by_deck.values())
-                    if missing_chunks:
-                        error = f"No se generaron tarjetas para {len(missing_chunks)} fragmentos"
-                        progress_data['status'] = 'error'
-                        progress_data['message'] = error
-                        progress_data['debug'] = f"Fragmentos sin tarjetas: {missing_chunks}"
-                        progress_data['partial_cards'] = flashcards_by_deck
-                        logger.warning(error)
-                    elif total_cards == 0:
-                        error = "No se generaron flashcards a partir del texto."
-                        progress_data['status'] = 'error'
-                        progress_data['message'] = error
-                        progress_data['debug'] = 'Sin tarjetas generadas'
-                        progress_data['partial_cards'] = flashcards_by_deck
-                        logger.warning(error)
-                    else:
-                        missing_after = quality_check(chunks, flashcards_by_deck)
-                        if missing_after:
-                            logger.warning(f"Fragmentos sin cobertura clara: {missing_after}")
-                            progress_data['debug'] = f"Faltan cubrir: {missing_after}"
-
-                        progress_data['status'] = 'completed'
-                        progress_data['message'] = '¡Tarjetas generadas!'
-                        progress_data['debug'] = 'Generación de tarjetas completada'
-                        logger.info(f"Tarjetas generadas: {total_cards} en total")
-
-                        progress_data['partial_cards'] = flashcards_by_deck
-
-                        flashcards_by_deck = limit_decks(flashcards_by_deck)
-                        progress_data['partial_cards'] = flashcards_by_deck
-                        out_path = os.path.join(tempfile.gettempdir(), f"{filename}.apkg")
-                        create_anki_apkg(flashcards_by_deck, out_path)
-                        download_url = f"/download/{os.path.basename(out_path)}"
-                        logger.info(f"Archivo .apkg disponible para descargar: {out_path}")
-                        progress_data['debug'] = f"Archivo .apkg creado: {os.path.basename(out_path)}"
-
-            except Exception as e:
-                error = f"Error al procesar el archivo: {str(e)}"
-                progress_data['status'] = 'error'
-                progress_data['message'] = error
-                progress_data['debug'] = error
-                logger.error(error)
-
-            finally:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.info(f"Archivo temporal eliminado: {file_path}")
-                    progress_data['debug'] = "Archivo temporal eliminado"
+                    logger.info(f"Trabajo {job.id} encolado")
+                    if wants_json:
+                        return jsonify(job.to_dict()), 202
 
     return render_template_string(
         HTML_TEMPLATE,
-        download_url=download_url,
-        flashcards_by_deck=flashcards_by_deck,
+        job_id=job.id if job else None,
         error=error,
-        uploaded_filename=(file.filename if request.method=="POST" and file else None)
+        uploaded_filename=(file.filename if file else None)
     )
 
-@app.route("/progress")
-def progress():
-    """Devuelve el estado del progreso."""
-    logger.debug(f"Estado del progreso: {progress_data}")
-    return jsonify(progress_data)
+@app.errorhandler(413)
+def upload_too_large(e):
+    """La petición supera ``MAX_CONTENT_LENGTH`` antes de llegar a ``index``."""
+    error = f"El archivo supera el límite de {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+    logger.warning(error)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': error}), 413
+    return render_template_string(HTML_TEMPLATE, job_id=None, error=error, uploaded_filename=None), 413
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    """Devuelve el estado de un trabajo."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(job.to_dict())
+
+def send_result(job_id, name):
+    """Envía un archivo del almacén de resultados.
+
+    Admite peticiones condicionales (ETag, If-Modified-Since) y por rangos,
+    de modo que una descarga interrumpida puede reanudarse.
+    """
+    meta = result_store.get(job_id)
+    if meta is None:
+        return jsonify({'error': 'Resultado no encontrado'}), 404
+    if name == ResultStore.CARDS:
+        return send_file(result_store.path(job_id, name), mimetype='application/json', conditional=True)
+    return send_file(
+        result_store.path(job_id, name),
+        as_attachment=True,
+        download_name=f"{meta['filename']}.apkg",
+        conditional=True,
+    )
+
+@app.route("/jobs/<job_id>/result")
+def get_job_result(job_id):
+    """Descarga el .apkg generado por un trabajo terminado."""
+    job = jobs.get(job_id)
+    if job is not None and job.status != 'completed':
+        return jsonify(job.to_dict()), 409
+    return send_result(job_id, ResultStore.PACKAGE)
+
+@app.route("/results")
+def list_results():
+    """Lista los resultados que se pueden volver a descargar."""
+    return jsonify(result_store.list())
+
+@app.route("/results/<job_id>")
+def get_result(job_id):
+    """Metadatos de un resultado guardado."""
+    meta = result_store.get(job_id)
+    if meta is None:
+        return jsonify({'error': 'Resultado no encontrado'}), 404
+    return jsonify(meta)
+
+@app.route("/results/<job_id>/package")
+def get_result_package(job_id):
+    return send_result(job_id, ResultStore.PACKAGE)
+
+@app.route("/results/<job_id>/cards")
+def get_result_cards(job_id):
+    return send_result(job_id, ResultStore.CARDS)
+
+@app.route("/backends")
+def get_backends():
+    """Estado de los servidores del modelo: carga, latencia media y fallos."""
+    return jsonify(llm_backends.to_dict())
+
+@app.route("/metrics")
+def get_metrics():
+    """Métricas en formato Prometheus: tiempos por etapa, modelo y trabajos."""
+    with jobs_lock:
+        evict_jobs()
+        statuses = Counter(job.status for job in jobs.values())
+    backends = llm_backends.to_dict()
+    gauges = [
+        ('flashcards_jobs', 'Trabajos en memoria por estado',
+         {(('status', status),): count for status, count in statuses.items()}),
+        ('flashcards_backend_in_flight', 'Peticiones en curso por servidor',
+         {(('backend', b['url']),): b['in_flight'] for b in backends}),
+    ]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route("/progress/<job_id>")
+def progress(job_id):
+    """Devuelve el estado del progreso de un trabajo."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    data = job.progress()
+    logger.debug(f"Estado del progreso: {data}")
+    return jsonify(data)
+
+@app.route("/stream/<job_id>")
+def stream(job_id):
+    """Envía actualizaciones de progreso en tiempo real mediante SSE.
+
+    El cliente recibe primero una instantánea y después sólo los cambios, en
+    cuanto el pipeline los publica. El stream se cierra al terminar el trabajo.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
 
-@app.route("/stream")
-def stream():
-    """Envía actualizaciones de progreso en tiempo real mediante SSE."""
     def event_stream():
-        last = None
-        while True:
-            data = json.dumps(progress_data)
-            if data != last:
-                yield f"data: {data}\n\n"
-                last = data
-            time.sleep(1)
+        version, cursor, snapshot = job.subscribe()
+        try:
+            yield f"data: {json.dumps(dict(snapshot, type='snapshot'))}\n\n"
+            state = snapshot
+            while state['status'] not in ('completed', 'error'):
+                new_version, new_state, events = job.wait_changes(version, cursor, SSE_KEEPALIVE)
+                if new_version == version:
+                    # Comentario SSE para mantener viva la conexión y detectar clientes caídos
+                    yield ": keepalive\n\n"
+                    continue
+                version = new_version
+                cursor += len(events)
+                for event in events:
+                    yield f"data: {json.dumps(event)}\n\n"
+                if new_state != state:
+                    state = new_state
+                    yield f"data: {json.dumps(dict(state, type='progress'))}\n\n"
+        finally:
+            # Sin clientes suscritos el trabajo no guarda eventos
+            job.unsubscribe(cursor)
 
     return Response(event_stream(), mimetype="text/event-stream")
 
 @app.route("/download/<filename>")
 def download_file(filename):
-    """Permite descargar el archivo .apkg."""
-    path = os.path.join(tempfile.gettempdir(), filename)
-    logger.info(f"Descargando archivo: {path}")
-    progress_data['debug'] = f"Descargando archivo: {filename}"
-    try:
-        return send_file(path, as_attachment=True)
-    except Exception as e:
-        logger.error(f"Error al descargar archivo: {e}")
-        progress_data['debug'] = f"Error al descargar: {e}"
-        raise
+    """Permite descargar el archivo .apkg (``<id del trabajo>.apkg``) desde el almacén."""
+    job_id = filename[:-len('.apkg')] if filename.endswith('.apkg') else filename
+    logger.info(f"Descargando resultado: {job_id}")
+    return send_result(job_id, ResultStore.PACKAGE)
+
+def find_documents(inputs, recursive=False):
+    """Archivos soportados a partir de directorios, rutas o patrones glob."""
+    found = []
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = '**/*' if recursive else '*'
+            candidates = Path(item).glob(pattern)
+        else:
+            candidates = (Path(p) for p in glob.glob(item, recursive=recursive))
+        for path in sorted(candidates):
+            if path.is_file() and path.suffix.lower() in SUPPORTED_EXTENSIONS:
+                resolved = str(path.resolve())
+                if resolved not in found:
+                    found.append(resolved)
+    return found
+
+
+def file_fingerprint(path):
+    """Hash del contenido, para saber si un archivo cambió desde el último lote."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run_batch(inputs, output_dir, workers=MAX_CONCURRENT_JOBS, merge=None, recursive=False, manifest_path=None):
+    """Convierte un lote de documentos sin pasar por la interfaz web.
+
+    Cada documento pasa por el mismo pipeline que una subida. El manifiesto
+    (JSON) registra los archivos terminados con su hash, de modo que al
+    relanzar el lote tras una interrupción sólo se procesan los pendientes,
+    los fallidos y los que cambiaron. Con ``merge`` se escribe además un único
+    paquete con un mazo padre por documento (``Documento::Tema``).
+    Devuelve el número de documentos con error.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(output_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    manifest_lock = threading.Lock()
+
+    def save_manifest():
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    files = find_documents(inputs, recursive)
+    names = {}
+    pending = []
+    for path in files:
+        stem = Path(path).stem
+        name = stem if stem not in names.values() else f"{stem}-{hashlib.sha1(path.encode()).hexdigest()[:6]}"
+        names[path] = name
+        entry = manifest.get(path)
+        if entry and entry['status'] == 'completed' and entry['fingerprint'] == file_fingerprint(path):
+            logger.info(f"Ya convertido, se omite: {path}")
+            continue
+        pending.append(path)
+    logger.info(f"Lote: {len(files)} documentos, {len(pending)} pendientes")
+
+    def convert(path):
+        name = names[path]
+        job = JobState(uuid.uuid4().hex, name, path)
+        out_path = None if merge else os.path.join(output_dir, f"{name}.apkg")
+        cards_path = os.path.join(output_dir, f"{name}.cards.json")
+        entry = {'status': 'processing', 'fingerprint': file_fingerprint(path), 'name': name}
+        try:
+            flashcards_by_deck = process_document(job, out_path)
+            with open(cards_path, 'w', encoding='utf-8') as f:
+                json.dump(flashcards_by_deck, f, ensure_ascii=False)
+            entry.update(
+                status='completed',
+                output=out_path,
+                cards=cards_path,
+                total_cards=sum(len(cards) for cards in flashcards_by_deck.values()),
+            )
+            logger.info(f"Convertido: {path} ({entry['total_cards']} tarjetas)")
+        except Exception as e:
+            entry.update(status='error', error=str(e))
+            logger.error(f"Error al convertir {path}: {e}")
+        finally:
+            shutil.rmtree(os.path.join(UPLOAD_FOLDER, job.id), ignore_errors=True)
+        with manifest_lock:
+            manifest[path] = entry
+            save_manifest()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch') as pool:
+        list(pool.map(convert, pending))
+
+    failed = [path for path in files if manifest.get(path, {}).get('status') != 'completed']
+    completed = [manifest[path] for path in files if path not in failed]
+    if merge and completed:
+        # Los documentos se vuelcan al paquete de uno en uno, sin reunirlos en memoria
+        with ApkgWriter(merge) as writer:
+            for entry in completed:
+                with open(entry['cards'], 'r', encoding='utf-8') as f:
+                    for deck, cards in json.load(f).items():
+                        writer.add_deck(f"{entry['name']}::{deck}", cards)
+        logger.info(f"Paquete combinado: {merge} ({writer.notes} notas)")
+    logger.info(f"Lote terminado: {len(files) - len(failed)} convertidos, {len(failed)} con error")
+    return len(failed)
+
+
+def main(argv=None):
+    """Punto de entrada: servidor web (por defecto) o conversión por lotes."""
+    parser = argparse.ArgumentParser(description="Generador de flashcards Anki")
+    subparsers = parser.add_subparsers(dest='command')
+    serve = subparsers.add_parser('serve', help="Inicia la aplicación web (por defecto)")
+    serve.add_argument('--port', type=int, default=5000)
+    convert = subparsers.add_parser('convert', help="Convierte directorios o patrones glob de documentos")
+    convert.add_argument('inputs', nargs='+', help="Directorios, archivos o patrones glob")
+    convert.add_argument('-o', '--output-dir', default='apkg_output')
+    convert.add_argument('-w', '--workers', type=int, default=MAX_CONCURRENT_JOBS)
+    convert.add_argument('-r', '--recursive', action='store_true')
+    convert.add_argument('--merge', metavar='APKG', help="Escribe un único paquete combinado")
+    convert.add_argument('--manifest', help="Ruta del manifiesto (por defecto en el directorio de salida)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        return 1 if run_batch(
+            args.inputs,
+            args.output_dir,
+            workers=args.workers,
+            merge=args.merge,
+            recursive=args.recursive,
+            manifest_path=args.manifest,
+        ) else 0
+
+    port = getattr(args, 'port', 5000)
+    logger.info(f"Iniciando la aplicación Flask en http://localhost:{port}")
+    app.run(debug=True, port=port)
+    return 0
 
 if __name__ == "__main__":
-    logger.info("Iniciando la aplicación Flask en http://localhost:5000")
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    sys.exit(main())
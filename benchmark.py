@@ -0,0 +1,552 @@
+"""Banco de pruebas del pipeline sin necesidad de un modelo real.
+
+Levanta un servidor que imita ``/api/chat`` de Ollama (latencia y velocidad
+de generación configurables, respuestas con el formato de tarjetas que espera
+``app.py``) y procesa un corpus de documentos sintéticos y reales con varios
+niveles de concurrencia. Cada escenario se ejecuta en un proceso propio, con
+la configuración de ``app.py`` en variables de entorno, y mide:
+
+- trabajos por minuto de principio a fin (subida incluida),
+- tiempo hasta la primera tarjeta y duración de cada trabajo,
+- tiempo por etapa (``timings`` de cada trabajo),
+- memoria residente máxima.
+
+Además compara el parser de tarjetas con el anterior sobre una respuesta del
+modelo de varios MB (``--parser-mb``).
+
+Los resultados se guardan en JSON para compararlos entre versiones::
+
+    python benchmark.py --concurrency 1,2,4 --output bench.json
+    python benchmark.py --env INDEPENDENT_CHUNKS=1 --baseline bench.json
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Estimated tokens per word, the same ratio app.py uses to size chunks
+TOKENS_PER_WORD = 1.3
+CHUNK_MARKER_PATTERN = re.compile(r'^=+\s*FRAGMENTO\s+\d+\s*=+$', re.M)
+HEADING_PATTERN = re.compile(r'^(?:\d{1,2}\.\s+\S.*|[A-ZÁÉÍÓÚÜÑ][A-ZÁÉÍÓÚÜÑ0-9 ,.:()-]{2,})$')
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?;])\s+|\n+')
+
+SYNTHETIC_TOPICS = (
+    "Fisiopatología", "Etiología", "Diagnóstico diferencial", "Exploración física",
+    "Pruebas complementarias", "Tratamiento", "Complicaciones", "Pronóstico",
+)
+SYNTHETIC_SENTENCES = (
+    "El {tema} se valora según la edad del paciente y la duración de los síntomas.",
+    "Los signos de alarma incluyen pérdida de peso, fiebre persistente y sangrado digestivo.",
+    "La anamnesis dirigida orienta la solicitud de estudios de laboratorio e imagen.",
+    "En el {tema} conviene descartar primero las causas orgánicas más frecuentes.",
+    "El seguimiento clínico periódico permite ajustar el tratamiento a la evolución.",
+    "La educación familiar reduce la ansiedad y mejora la adherencia terapéutica.",
+)
+
+
+class StubOllama:
+    """Servidor local que responde como ``/api/chat`` de Ollama.
+
+    Cada petición espera ``latency`` segundos y después genera la respuesta a
+    ``tokens_per_second`` (en streaming, por trozos). Como mucho se atienden
+    ``parallel`` peticiones a la vez, igual que ``OLLAMA_NUM_PARALLEL``; el
+    resto esperan turno. La respuesta tiene una tarjeta por frase del texto
+    recibido, agrupada bajo el último encabezado visto, y repite los
+    marcadores de fragmento de los lotes. Si la petición trae ``format``
+    responde con el JSON de ``CARDS_SCHEMA``.
+    """
+
+    def __init__(self, latency=0.2, tokens_per_second=200.0, parallel=4, max_cards=40):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.max_cards = max_cards
+        self.slots = threading.BoundedSemaphore(parallel)
+        self.parallel = parallel
+        self.requests = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/api/chat"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def cards(self, text):
+        """Tarjetas para ``text``: ``(fragmento, mazo, pregunta, respuesta)``."""
+        cards = []
+        deck = "GENERAL"
+        chunk = 1
+        for part in re.split(r'(' + CHUNK_MARKER_PATTERN.pattern + r')', text, flags=re.M):
+            if CHUNK_MARKER_PATTERN.match(part):
+                chunk = int(re.search(r'\d+', part).group())
+                continue
+            for sentence in SENTENCE_PATTERN.split(part):
+                sentence = sentence.strip()
+                if not sentence:
+                    continue
+                if HEADING_PATTERN.match(sentence):
+                    deck = sentence.rstrip(':').upper()
+                    continue
+                if len(cards) >= self.max_cards or len(sentence.split()) < 4:
+                    continue
+                subject = " ".join(sentence.split()[:4])
+                cards.append((chunk, deck, f"¿Qué dice el texto sobre {subject}?", f"<ul><li>{sentence}</li></ul>"))
+        return cards
+
+    def reply(self, text, structured=False):
+        """Respuesta con el formato de tarjetas de ``PROMPT`` o, con ``structured``, de ``CARDS_SCHEMA``."""
+        cards = self.cards(text)
+        batched = CHUNK_MARKER_PATTERN.search(text) is not None
+        if structured:
+            decks = []
+            for chunk, deck, question, answer in cards:
+                if not decks or (decks[-1]['chunk'], decks[-1]['name']) != (chunk, deck):
+                    decks.append({'name': deck, 'chunk': chunk, 'cards': []})
+                decks[-1]['cards'].append({'question': question, 'answer': answer})
+            return json.dumps({'decks': decks}, ensure_ascii=False)
+        lines = []
+        previous = (None, None)
+        for chunk, deck, question, answer in cards:
+            if batched and chunk != previous[0]:
+                lines.append(f"=== FRAGMENTO {chunk} ===")
+            if (chunk, deck) != previous:
+                lines.extend(["---", f"[{deck}]", ""])
+            previous = (chunk, deck)
+            lines.extend(["---", f"Pregunta: {question}", f"Respuesta: {answer}"])
+        lines.append("---")
+        return "\n".join(lines)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                text = body['messages'][-1]['content']
+                with stub.slots:
+                    reply = stub.reply(text, bool(body.get('format')))
+                    tokens = max(1, round(len(reply.split()) * TOKENS_PER_WORD))
+                    generation = tokens / stub.tokens_per_second if stub.tokens_per_second else 0.0
+                    time.sleep(stub.latency)
+                    usage = {
+                        'done': True,
+                        'prompt_eval_count': round(len(text.split()) * TOKENS_PER_WORD),
+                        'eval_count': tokens,
+                        'eval_duration': int(generation * 1e9) or 1,
+                    }
+                    if body.get('stream'):
+                        self.stream(reply, generation, usage)
+                    else:
+                        time.sleep(generation)
+                        self.send_json({'message': {'role': 'assistant', 'content': reply}, **usage})
+                with stub._lock:
+                    stub.requests += 1
+                    stub.completion_tokens += tokens
+
+            def send_json(self, data):
+                out = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def stream(self, reply, generation, usage):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                pieces = re.findall(r'\S+\s*|\s+', reply)
+                # Se envían unas 20 piezas por segundo para no medir sólo el coste del HTTP
+                step = max(1, round(len(pieces) / max(1.0, generation * 20)))
+                for start in range(0, len(pieces), step):
+                    piece = "".join(pieces[start:start + step])
+                    self.write_line({'message': {'role': 'assistant', 'content': piece}, 'done': False})
+                    time.sleep(generation * step / len(pieces))
+                self.write_line({'message': {'role': 'assistant', 'content': ''}, **usage})
+                self.wfile.write(b"0\r\n\r\n")
+
+            def write_line(self, data):
+                line = (json.dumps(data) + "\n").encode()
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def synthetic_text(topics, sentences_per_topic):
+    """Documento con encabezados numerados y frases de contenido clínico."""
+    parts = []
+    for n in range(topics):
+        tema = SYNTHETIC_TOPICS[n % len(SYNTHETIC_TOPICS)]
+        parts.append(f"{n + 1:02d}. {tema} {n + 1}")
+        body = []
+        for k in range(sentences_per_topic):
+            template = SYNTHETIC_SENTENCES[k % len(SYNTHETIC_SENTENCES)]
+            body.append(template.format(tema=tema.lower()) + f" Caso {n + 1}.{k + 1}.")
+        parts.append(" ".join(body))
+    return "\n\n".join(parts)
+
+
+def build_corpus(folder, documents=()):
+    """Escribe el corpus sintético en ``folder`` y añade los documentos reales.
+
+    Los documentos reales son los PDF que acompañan al repositorio más los
+    indicados en ``documents``.
+    """
+    import docx
+
+    corpus = []
+    for name, topics, sentences in (('sintetico-corto', 6, 12), ('sintetico-largo', 40, 30)):
+        path = os.path.join(folder, f"{name}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(synthetic_text(topics, sentences))
+        corpus.append({'name': name, 'path': path, 'kind': 'synthetic'})
+
+    path = os.path.join(folder, 'sintetico-docx.docx')
+    document = docx.Document()
+    for paragraph in synthetic_text(12, 15).split("\n\n"):
+        document.add_paragraph(paragraph)
+    document.save(path)
+    corpus.append({'name': 'sintetico-docx', 'path': path, 'kind': 'synthetic'})
+
+    for path in sorted(glob.glob(os.path.join(ROOT, '*.pdf'))) + list(documents):
+        corpus.append({'name': os.path.splitext(os.path.basename(path))[0], 'path': os.path.abspath(path), 'kind': 'real'})
+    for document in corpus:
+        document['bytes'] = os.path.getsize(document['path'])
+    return corpus
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        'mean': round(statistics.fmean(ordered), 4),
+        'p50': round(pick(0.5), 4),
+        'p95': round(pick(0.95), 4),
+        'max': round(ordered[-1], 4),
+    }
+
+
+def watch_job(job, submitted_at, result):
+    """Espera a que termine el trabajo anotando cuándo llega la primera tarjeta."""
+    version, cursor, state = job.subscribe()
+    if any(state['cards'].values()) or state['streaming']:
+        result['first_card'] = time.perf_counter() - submitted_at
+    try:
+        while state['status'] not in ('completed', 'error'):
+            version, state, events = job.wait_changes(version, cursor, 1.0)
+            cursor += len(events)
+            if 'first_card' not in result and any(
+                event['type'] == 'stream_card' or (event['type'] == 'cards' and any(event['cards'].values()))
+                for event in events
+            ):
+                result['first_card'] = time.perf_counter() - submitted_at
+        result['seconds'] = time.perf_counter() - submitted_at
+    finally:
+        job.unsubscribe(cursor)
+
+
+LEGACY_Q_PATTERN = re.compile(r'^(?:preg(?:unta)?|question|q)\s*[:\-]?\s*(.*)', re.I)
+LEGACY_A_PATTERN = re.compile(r'^(?:resp(?:uesta)?|answer|a)\s*[:\-]?\s*(.*)', re.I)
+LEGACY_HEADING_PATTERN = re.compile(r'^(?:\d{1,2}\.|[IVX]+\.)?\s*[A-ZÁÉÍÓÚÜÑ0-9 ,.:-]+$', re.I)
+
+
+def legacy_parse(output):
+    """Parser anterior (una línea cada vez, tres expresiones por línea), como referencia."""
+    cards = {}
+    deck, question = "General", ""
+    for line in output.strip().split('\n'):
+        line = line.strip()
+        if not line or line.startswith('---'):
+            continue
+        q_match = LEGACY_Q_PATTERN.match(line)
+        if q_match:
+            question = q_match.group(1).strip()
+            continue
+        a_match = LEGACY_A_PATTERN.match(line)
+        if a_match and question:
+            cards.setdefault(deck, []).append((question, a_match.group(1).strip()))
+            question = ""
+            continue
+        if not question and LEGACY_HEADING_PATTERN.match(line):
+            deck = line.rstrip(':').strip() or "General"
+    return cards
+
+
+def model_output(megabytes):
+    """Respuesta del modelo de unos ``megabytes`` MB con tarjetas de varios formatos."""
+    blocks = []
+    size = 0
+    n = 0
+    while size < megabytes * 1024 * 1024:
+        n += 1
+        block = (
+            f"---\n[Tema {n}]\n\n"
+            f"Pregunta: ¿Qué caracteriza el cuadro {n}?\n"
+            f"Respuesta: <ul><li>Dolor <strong>recurrente</strong> {n}</li><li>Sin signos de alarma</li></ul>\n"
+            f"---\nPregunta: ¿Qué estudios se piden en el caso {n}?\n"
+            f"Respuesta:\n<ul>\n<li>Hemograma</li>\n<li>Ecografía abdominal</li>\n</ul>\n"
+            f"---\n**Pregunta:** ¿Cuál es el tratamiento {n}?\n"
+            f"**Respuesta:**\n- Dieta\n- Educación familiar\n- Seguimiento\n"
+        )
+        blocks.append(block)
+        size += len(block.encode())
+    return "".join(blocks) + "---\n", 3 * n
+
+
+def run_parser_benchmark(spec):
+    """Compara el parser actual con el anterior sobre una respuesta de varios MB."""
+    sys.path.insert(0, ROOT)
+    import app
+
+    output, expected = model_output(spec['parser_mb'])
+    result = {'bytes': len(output.encode()), 'expected_cards': expected}
+    for name, parse in (
+        ('legacy', legacy_parse),
+        ('single_pass', lambda text: app.CardParser().parse(text)),
+    ):
+        start = time.perf_counter()
+        cards = parse(output)
+        seconds = time.perf_counter() - start
+        answers = [answer for deck_cards in cards.values() for _, answer in deck_cards]
+        result[name] = {
+            'seconds': round(seconds, 4),
+            'mb_per_second': round(result['bytes'] / seconds / 1024 / 1024, 2),
+            'cards': len(answers),
+            'empty_answers': sum(not answer for answer in answers),
+        }
+    return result
+
+
+def run_scenario(spec):
+    """Ejecuta un escenario dentro del proceso actual (llamado con ``--worker``)."""
+    sys.path.insert(0, ROOT)
+    import app
+
+    client = app.app.test_client()
+    watchers = []
+    results = []
+    started = time.perf_counter()
+    for repeat in range(spec['repeat']):
+        for document in spec['corpus']:
+            submitted_at = time.perf_counter()
+            with open(document['path'], 'rb') as f:
+                response = client.post(
+                    '/',
+                    data={'file': (f, os.path.basename(document['path']))},
+                    headers={'Accept': 'application/json'},
+                )
+            if response.status_code != 202:
+                results.append({'document': document['name'], 'status': 'rejected'})
+                continue
+            job = app.jobs[response.json['id']]
+            result = {'document': document['name'], 'job': job}
+            watcher = threading.Thread(target=watch_job, args=(job, submitted_at, result))
+            watcher.start()
+            watchers.append(watcher)
+            results.append(result)
+    for watcher in watchers:
+        watcher.join()
+    wall = time.perf_counter() - started
+
+    if app.process_pool is not None:
+        app.process_pool.shutdown()
+    stages = {}
+    completed = [r for r in results if 'job' in r and r['job'].status == 'completed']
+    for result in completed:
+        for stage, timing in result['job'].timing_breakdown().items():
+            total = stages.setdefault(stage, {'seconds': 0.0, 'count': 0})
+            total['seconds'] += timing['seconds']
+            total['count'] += timing['count']
+    for stage in stages.values():
+        stage['seconds_per_job'] = round(stage['seconds'] / len(completed), 4)
+        stage['seconds'] = round(stage['seconds'], 4)
+
+    return {
+        'jobs': len(results),
+        'completed': len(completed),
+        'errors': [
+            {'document': r['document'], 'error': r['job'].error if 'job' in r else r['status']}
+            for r in results if 'job' not in r or r['job'].status != 'completed'
+        ],
+        'wall_seconds': round(wall, 3),
+        'jobs_per_minute': round(len(completed) / wall * 60, 2) if wall else None,
+        'cards': sum(r['job'].total_cards for r in completed),
+        'time_to_first_card': percentiles([r['first_card'] for r in completed if 'first_card' in r]),
+        'job_seconds': percentiles([r['seconds'] for r in completed]),
+        'stages': stages,
+        'per_document': {
+            document['name']: percentiles([r['seconds'] for r in completed if r['document'] == document['name']])
+            for document in spec['corpus']
+        },
+        # ru_maxrss está en KiB en Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_rss_children_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def launch_worker(spec, env):
+    """Ejecuta ``spec`` en un proceso nuevo, en una carpeta temporal, y devuelve su resultado."""
+    with tempfile.TemporaryDirectory(prefix='bench-') as workdir:
+        spec_path = os.path.join(workdir, 'spec.json')
+        with open(spec_path, 'w', encoding='utf-8') as f:
+            json.dump(spec, f)
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', spec_path],
+            cwd=workdir, env=dict(os.environ, **env), stdout=subprocess.PIPE, check=True,
+        )
+        return json.loads(process.stdout.decode().strip().splitlines()[-1])
+
+
+def launch_scenario(stub, corpus, concurrency, repeat, env):
+    """Lanza un escenario en un proceso nuevo con su propia configuración."""
+    scenario_env = dict(
+        OLLAMA_URL=stub.url,
+        MAX_CONCURRENT_JOBS=str(concurrency),
+        MAX_QUEUED_JOBS=str(len(corpus) * repeat + 1),
+        # Sin caché ni reutilización de versiones: cada trabajo llama al modelo
+        LLM_CACHE_PATH='',
+        INCREMENTAL_UPDATES='0',
+        **env,
+    )
+    requests_before = stub.requests
+    result = launch_worker({'corpus': corpus, 'repeat': repeat}, scenario_env)
+    result['llm_requests'] = stub.requests - requests_before
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Muestra la variación de los escenarios respecto a una ejecución anterior."""
+    previous = {(s['concurrency'], json.dumps(s['env'], sort_keys=True)): s for s in baseline['scenarios']}
+    for scenario in results['scenarios']:
+        old = previous.get((scenario['concurrency'], json.dumps(scenario['env'], sort_keys=True)))
+        if old is None:
+            continue
+        changes = []
+        for label, get in (
+            ('trabajos/min', lambda s: s['jobs_per_minute']),
+            ('primera tarjeta p50', lambda s: (s['time_to_first_card'] or {}).get('p50')),
+            ('trabajo p50', lambda s: (s['job_seconds'] or {}).get('p50')),
+            ('RSS', lambda s: s['peak_rss_mb']),
+        ):
+            new_value, old_value = get(scenario), get(old)
+            if new_value is not None and old_value:
+                changes.append(f"{label} {(new_value - old_value) / old_value:+.1%}")
+        print(f"  concurrencia {scenario['concurrency']}: " + ", ".join(changes))
+    if results.get('parser') and baseline.get('parser'):
+        new_value = results['parser']['single_pass']['mb_per_second']
+        old_value = baseline['parser']['single_pass']['mb_per_second']
+        print(f"  parser: MB/s {(new_value - old_value) / old_value:+.1%}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--concurrency', default='1,2,4', help='Trabajos simultáneos por escenario (lista separada por comas)')
+    parser.add_argument('--repeat', type=int, default=1, help='Veces que se procesa el corpus en cada escenario')
+    parser.add_argument('--latency', type=float, default=0.2, help='Segundos antes de que el modelo empiece a responder')
+    parser.add_argument('--tokens-per-second', type=float, default=200.0, help='Velocidad de generación del modelo simulado')
+    parser.add_argument('--parallel', type=int, default=4, help='Peticiones que el modelo simulado atiende a la vez')
+    parser.add_argument('--document', action='append', default=[], help='Documento adicional para el corpus')
+    parser.add_argument('--env', action='append', default=[], metavar='CLAVE=VALOR', help='Configuración de app.py para los escenarios')
+    parser.add_argument('--output', default='benchmark_results.json', help='Archivo JSON de resultados')
+    parser.add_argument('--baseline', help='Resultados anteriores con los que comparar')
+    parser.add_argument('--parser-mb', type=float, default=4, help='Tamaño de la respuesta para medir el parser (0 = no medir)')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        with open(args.worker, 'r', encoding='utf-8') as f:
+            spec = json.load(f)
+        print(json.dumps(run_parser_benchmark(spec) if 'parser_mb' in spec else run_scenario(spec)))
+        return 0
+
+    env = dict(item.split('=', 1) for item in args.env)
+    levels = [int(level) for level in args.concurrency.split(',') if level]
+    with tempfile.TemporaryDirectory(prefix='bench-corpus-') as folder, StubOllama(
+        args.latency, args.tokens_per_second, args.parallel
+    ) as stub:
+        corpus = build_corpus(folder, args.document)
+        results = {
+            'created_at': time.time(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'stub': {'latency': args.latency, 'tokens_per_second': args.tokens_per_second, 'parallel': args.parallel},
+            'corpus': [{key: document[key] for key in ('name', 'kind', 'bytes')} for document in corpus],
+            'scenarios': [],
+        }
+        for concurrency in levels:
+            print(f"Escenario: {concurrency} trabajos simultáneos", file=sys.stderr)
+            scenario = launch_scenario(stub, corpus, concurrency, args.repeat, env)
+            results['scenarios'].append({'concurrency': concurrency, 'env': env, **scenario})
+            ttfc = scenario['time_to_first_card'] or {}
+            print(
+                f"  {scenario['completed']}/{scenario['jobs']} trabajos, "
+                f"{scenario['jobs_per_minute']} trabajos/min, "
+                f"primera tarjeta p50 {ttfc.get('p50')} s, RSS {scenario['peak_rss_mb']} MB",
+                file=sys.stderr,
+            )
+        if args.parser_mb:
+            print(f"Parser: respuesta de {args.parser_mb} MB", file=sys.stderr)
+            results['parser'] = launch_worker({'parser_mb': args.parser_mb}, {})
+            for name in ('legacy', 'single_pass'):
+                run = results['parser'][name]
+                print(
+                    f"  {name}: {run['seconds']} s ({run['mb_per_second']} MB/s), {run['cards']} tarjetas, "
+                    f"{run['empty_answers']} respuestas vacías",
+                    file=sys.stderr,
+                )
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Resultados guardados en {args.output}", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# app.py abre la caché de respuestas al importarse; en las pruebas no se usa
+os.environ.setdefault('LLM_CACHE_PATH', '')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
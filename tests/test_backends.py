@@ -0,0 +1,55 @@
+import socket
+
+import pytest
+
+import app
+from app import BackendPool, CircuitBreaker, JobState
+from benchmark import StubOllama
+
+
+@pytest.fixture
+def pool(monkeypatch, tmp_path):
+    # call_phi3 escribe prompts_log.txt en el directorio actual
+    monkeypatch.chdir(tmp_path)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        dead = f"http://127.0.0.1:{s.getsockname()[1]}/api/chat"
+    with StubOllama(latency=0, tokens_per_second=100000) as stub:
+        pool = BackendPool.from_config([{'url': dead}, {'url': stub.url}])
+        pool.backends[0].breaker = CircuitBreaker(1, 60)
+        monkeypatch.setattr(app, 'llm_backends', pool)
+        yield pool
+
+
+def job(tmp_path):
+    return JobState('prueba', 'doc.txt', str(tmp_path / 'doc.txt'))
+
+
+def test_failover_to_a_live_server(pool, tmp_path):
+    dead, live = pool.backends
+    reply = app.call_phi3("01. FIEBRE\nLa fiebre es una temperatura mayor de 38 grados.", job(tmp_path),
+                          retries=2, initial_delay=0, history=[])
+    assert "Pregunta:" in reply
+    assert [b['in_flight'] for b in pool.to_dict()] == [0, 0]
+    assert (dead.failures, dead.breaker.state()) == (1, 'open')
+    assert (live.requests, live.failures, live.breaker.state()) == (1, 0, 'closed')
+    assert pool.acquire() is live
+    pool.abandon(live)
+
+
+def test_cancelled_call_releases_its_slot(pool, tmp_path):
+    dead, live = pool.backends
+    dead.breaker.record_failure()
+
+    class Stream:
+        def reset(self):
+            pass
+
+        def feed(self, line):
+            raise RuntimeError("cancelado")
+
+    with pytest.raises(RuntimeError):
+        app.call_phi3("Texto del fragmento.", job(tmp_path), retries=2, initial_delay=0, history=[],
+                      card_stream=Stream())
+    assert [b['in_flight'] for b in pool.to_dict()] == [0, 0]
+    assert (live.failures, live.breaker.state()) == (0, 'closed')
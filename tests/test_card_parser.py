@@ -0,0 +1,178 @@
+from app import CardParser
+
+
+def parse(output, chunk_ids=None):
+    parser = CardParser(chunk_ids)
+    return parser.parse(output), parser.errors
+
+
+def test_prompt_format():
+    cards, errors = parse(
+        "[Fiebre]\n"
+        "Pregunta: ¿Qué es la fiebre?\n"
+        "Respuesta: Temperatura mayor de 38 °C.\n"
+        "---\n"
+        "Pregunta: ¿Causas?\n"
+        "Respuesta: <ul><li>Infecciones</li><li>Tumores</li></ul>\n"
+    )
+    assert cards == {'Fiebre': [
+        ('¿Qué es la fiebre?', 'Temperatura mayor de 38 °C.'),
+        ('¿Causas?', '<ul><li>Infecciones</li><li>Tumores</li></ul>'),
+    ]}
+    assert errors == []
+
+
+def test_numbered_labels():
+    cards, errors = parse(
+        "Pregunta 1: ¿Qué es?\n"
+        "Respuesta 1: Algo.\n"
+        "**Pregunta 2:** ¿Y esto?\n"
+        "**Respuesta 2:** Otra cosa.\n"
+        "Q3: ¿Short?\n"
+        "A3: Yes.\n"
+    )
+    assert cards == {'General': [('¿Qué es?', 'Algo.'), ('¿Y esto?', 'Otra cosa.'), ('¿Short?', 'Yes.')]}
+    assert errors == []
+
+
+def test_title_case_heading_after_blank_line():
+    cards, errors = parse(
+        "Pregunta: ¿Umbral de fiebre?\n"
+        "Respuesta: Temp > 38\n"
+        "\n"
+        "Tratamiento empírico\n"
+        "Pregunta: ¿Primera elección?\n"
+        "Respuesta: Ceftriaxona\n"
+    )
+    assert cards == {
+        'General': [('¿Umbral de fiebre?', 'Temp > 38')],
+        'Tratamiento empírico': [('¿Primera elección?', 'Ceftriaxona')],
+    }
+    assert errors == []
+
+
+def test_capitalised_continuation_lines():
+    cards, errors = parse(
+        "[Tema]\n"
+        "Pregunta: ¿Fármacos?\n"
+        "Respuesta: Paracetamol\n"
+        "Ibuprofeno\n"
+        "Metamizol\n"
+        "Pregunta: ¿Causas?\n"
+        "Respuesta: Las más frecuentes son:\n"
+        "Infección urinaria\n"
+        "Litiasis renal\n"
+        "Pregunta: ¿Siguiente?\n"
+        "Respuesta: Sí\n"
+    )
+    assert cards == {'Tema': [
+        ('¿Fármacos?', 'Paracetamol<br>Ibuprofeno<br>Metamizol'),
+        ('¿Causas?', 'Las más frecuentes son:<br>Infección urinaria<br>Litiasis renal'),
+        ('¿Siguiente?', 'Sí'),
+    ]}
+    assert errors == []
+
+
+def test_capitals_heading_cutting_an_answer_is_reported():
+    cards, errors = parse(
+        "Pregunta: ¿Umbral?\n"
+        "Respuesta: Temp > 38\n"
+        "TRATAMIENTO\n"
+        "Pregunta: ¿Primera elección?\n"
+        "Respuesta: Ceftriaxona\n"
+    )
+    assert cards == {
+        'General': [('¿Umbral?', 'Temp > 38')],
+        'TRATAMIENTO': [('¿Primera elección?', 'Ceftriaxona')],
+    }
+    assert [(e['line'], e['error'], e['text']) for e in errors] == [
+        (3, 'Respuesta cortada por un encabezado', '¿Umbral?'),
+    ]
+
+
+def test_stray_text_is_reported_not_a_deck():
+    cards, errors = parse(
+        "Aquí tienes las flashcards\n"
+        "01. Introducción\n"
+        "Pregunta: ¿Definición?\n"
+        "Respuesta: Dolor abdominal\n"
+        "\n"
+        "que dura más de dos meses\n"
+    )
+    assert cards == {'01. Introducción': [('¿Definición?', 'Dolor abdominal')]}
+    assert [(e['line'], e['error']) for e in errors] == [
+        (1, 'Texto fuera de una tarjeta'),
+        (6, 'Texto fuera de una tarjeta'),
+    ]
+
+
+def test_multiline_answers():
+    cards, _ = parse(
+        "Pregunta: ¿Tipos?\n"
+        "Respuesta: Según el origen:\n"
+        "- Orgánico\n"
+        "- Funcional\n"
+        "Pregunta: ¿Definición?\n"
+        "Respuesta: Dolor de más de dos meses\n"
+        "que interfiere con la actividad diaria.\n"
+    )
+    assert cards['General'] == [
+        ('¿Tipos?', 'Según el origen:<ul><li>Orgánico</li><li>Funcional</li></ul>'),
+        ('¿Definición?', 'Dolor de más de dos meses<br>que interfiere con la actividad diaria.'),
+    ]
+
+
+def test_question_without_answer_is_reported():
+    cards, errors = parse(
+        "Pregunta: ¿Sin respuesta?\n"
+        "texto que queda bajo la pregunta\n"
+        "Pregunta: ¿Con respuesta?\n"
+        "Respuesta: Sí.\n"
+    )
+    assert cards == {'General': [('¿Con respuesta?', 'Sí.')]}
+    assert [(e['line'], e['error']) for e in errors] == [(3, 'Pregunta sin respuesta')]
+    assert errors[0]['text'] == '¿Sin respuesta? texto que queda bajo la pregunta'
+
+
+def test_reply_without_cards_is_reported():
+    cards, errors = parse("Lo siento, no puedo generar tarjetas para este texto.\n")
+    assert cards == {}
+    assert [e['error'] for e in errors] == ['Texto fuera de una tarjeta']
+    cards, errors = parse("DOLOR ABDOMINAL\n")
+    assert cards == {}
+    assert [e['error'] for e in errors] == ['Respuesta sin tarjetas reconocibles']
+
+
+def test_unclosed_list_is_repaired():
+    cards, errors = parse(
+        "Pregunta: ¿Lista?\nRespuesta: <ul><li>Uno</li>\n<li>Dos</li>\n"
+        "Pregunta: ¿Otra?\nRespuesta: <ul><li>Uno\n"
+    )
+    assert cards['General'] == [
+        ('¿Lista?', '<ul><li>Uno</li>\n<li>Dos</li></ul>'),
+        ('¿Otra?', '<ul><li>Uno</li></ul>'),
+    ]
+    assert [e['error'] for e in errors] == ['Lista HTML sin cerrar'] * 2
+
+
+def test_chunk_markers():
+    # Los marcadores numeran los fragmentos del documento desde 1
+    parser = CardParser([4, 5])
+    parser.parse(
+        "=== FRAGMENTO 5 ===\n"
+        "Pregunta: ¿Uno?\nRespuesta: 1\n"
+        "=== FRAGMENTO 6 ===\n"
+        "Pregunta: ¿Dos?\nRespuesta: 2\n"
+        "=== FRAGMENTO 9 ===\n"
+    )
+    assert parser.by_chunk == {4: {'General': [('¿Uno?', '1')]}, 5: {'General': [('¿Dos?', '2')]}}
+    assert [e['error'] for e in parser.errors] == ['Marcador de fragmento desconocido: 9']
+
+
+def test_feed_matches_parse():
+    output = "[Tema]\nPregunta: ¿A?\nRespuesta: a\nPregunta: ¿B?\nRespuesta: b\n"
+    parser = CardParser()
+    closed = [card for card in map(parser.feed, output.splitlines()) if card]
+    closed.append(parser.finish())
+    assert closed == [(None, 'Tema', '¿A?', 'a'), (None, 'Tema', '¿B?', 'b')]
+    assert parser.cards == CardParser().parse(output)
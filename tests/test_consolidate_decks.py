@@ -0,0 +1,56 @@
+from collections import OrderedDict
+
+from app import consolidate_decks, deck_root
+
+
+def medical_decks():
+    decks = OrderedDict()
+    decks['Fiebre::Causas'] = [
+        ("¿Causas de fiebre?", "Infecciones víricas y bacterianas"),
+        ("¿Fiebre de origen desconocido?", "Fiebre de más de tres semanas sin causa"),
+    ]
+    decks['Asma'] = [("¿Qué es el asma?", "Inflamación crónica de la vía aérea")]
+    decks['Tratamiento'] = [("¿Tratamiento de la fiebre?", "Antitérmicos y tratar la infección")]
+    decks['Fiebre::Diagnóstico'] = [("¿Diagnóstico de fiebre?", "Temperatura mayor de 38 grados")]
+    decks['EPOC'] = [("¿Qué es la EPOC?", "Obstrucción crónica de la vía aérea")]
+    return decks
+
+
+def test_few_top_level_decks_are_unchanged():
+    decks = medical_decks()
+    assert consolidate_decks(decks, 4) == decks
+
+
+def test_merged_decks_become_subdecks():
+    decks = medical_decks()
+    consolidated = consolidate_decks(decks, 2)
+    assert list(consolidated) == [
+        'Fiebre::Causas', 'Fiebre::Tratamiento', 'Fiebre::Diagnóstico',
+        'Asma', 'Asma::EPOC',
+    ]
+    assert consolidated['Fiebre::Tratamiento'] == decks['Tratamiento']
+    assert sum(map(len, consolidated.values())) == sum(map(len, decks.values()))
+
+
+def test_group_names_are_unique():
+    decks = OrderedDict((f"Tema {n}", [(f"¿Pregunta {n}?", "Respuesta común")]) for n in range(20))
+    decks['General'] = [("¿Otra?", "Respuesta común")]
+    consolidated = consolidate_decks(decks, 3)
+    roots = {deck_root(deck) for deck in consolidated}
+    assert len(roots) == 3
+    cards = [card for deck_cards in consolidated.values() for card in deck_cards]
+    assert sorted(cards) == sorted(card for deck_cards in decks.values() for card in deck_cards)
+
+
+def test_renamed_decks_do_not_collide_with_existing_subdecks():
+    decks = OrderedDict()
+    decks['A'] = [("¿Qué es A?", "Definición de la materia")]
+    decks['B'] = [("¿Qué es B?", "Definición de la materia")]
+    decks['A::B'] = [("¿Qué es A::B?", "Definición de la materia")]
+    for n in range(6):
+        decks[f"Otro {n}"] = [(f"¿Tema {n} distinto?", f"Palabras propias {n} sin relación")]
+    consolidated = consolidate_decks(decks, 6)
+    assert sum(map(len, consolidated.values())) == sum(map(len, decks.values()))
+    assert consolidated['A::B'] == decks['A::B']
+    assert consolidated['A::B (2)'] == decks['B']
+    assert len({deck_root(deck) for deck in consolidated}) <= 6
@@ -0,0 +1,34 @@
+from collections import OrderedDict
+
+from app import deduplicate_cards
+
+
+def test_merges_exact_and_near_duplicates_across_decks():
+    decks = OrderedDict()
+    decks['A'] = [
+        ("¿Qué es el dolor abdominal crónico?", "Dolor de más de dos meses"),
+        ("¿Causas?", "Orgánicas y funcionales"),
+    ]
+    decks['B'] = [
+        ("¿Que es el dolor abdominal cronico?", "<ul><li>Dolor de más de dos meses</li></ul>"),
+        ("¿Qué es el dolor abdominal crónico?", "Dolor de más de dos meses, con o sin síntomas"),
+    ]
+    merged_decks, merged = deduplicate_cards(decks)
+    assert merged == 1
+    assert list(merged_decks) == ['A', 'B']
+    assert merged_decks['A'][1] == ("¿Causas?", "Orgánicas y funcionales")
+    assert len(merged_decks['B']) == 1
+
+
+def test_cards_without_words_are_kept():
+    decks = OrderedDict(D=[('¿α?', 'β'), ('¿γ?', 'δ'), ('¿α?', 'β')])
+    merged_decks, merged = deduplicate_cards(decks)
+    assert merged == 0
+    assert merged_decks == decks
+
+
+def test_longest_answer_wins():
+    decks = OrderedDict(D=[("¿Fiebre?", "Más de 38"), ("¿Fiebre?", "<b>Más de 38 °C</b> axilar")])
+    merged_decks, merged = deduplicate_cards(decks, threshold=0.3)
+    assert merged == 1
+    assert merged_decks['D'] == [("¿Fiebre?", "<b>Más de 38 °C</b> axilar")]
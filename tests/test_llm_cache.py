@@ -0,0 +1,27 @@
+import app
+from app import LLMCache
+
+
+class Job:
+    def update(self, **kwargs):
+        pass
+
+
+def cached(monkeypatch, reply):
+    cache = LLMCache(':memory:', 1 << 20)
+    monkeypatch.setattr(app, 'llm_cache', cache)
+    history = []
+    app._end_call(Job(), history, reply, 'modelo', 'sistema', 'texto')
+    assert history == [{'role': 'assistant', 'content': reply}]
+    return cache.get(LLMCache.make_key('sistema', 'texto', 'modelo', app.LLM_OPTIONS))
+
+
+def test_replies_with_cards_are_cached(monkeypatch):
+    reply = "Pregunta: ¿Fiebre?\nRespuesta: Más de 38 °C\n"
+    assert cached(monkeypatch, reply) == reply
+
+
+def test_replies_without_cards_are_not_cached(monkeypatch):
+    assert cached(monkeypatch, "Lo siento, no puedo generar tarjetas para este texto.") is None
+    assert cached(monkeypatch, "DOLOR ABDOMINAL\n") is None
+    assert cached(monkeypatch, "   ") is None
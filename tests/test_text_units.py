@@ -0,0 +1,30 @@
+from app import iter_text_units
+
+
+def test_units_are_yielded_before_the_document_ends():
+    consumed = []
+
+    def pages():
+        for n in range(1000):
+            consumed.append(n)
+            yield f"Texto de la página {n}.\nSigue el párrafo sin líneas en blanco.\n"
+
+    units = iter_text_units(pages(), 50)
+    next(units)
+    assert len(consumed) < 10
+
+
+def test_headings_after_a_single_newline_start_a_unit():
+    units = list(iter_text_units(["Intro del texto\nDIARREA AGUDA\nTexto de la ", "diarrea.\n\nOtro párrafo"], 100))
+    assert units == [
+        ('Intro del texto', '\n\n'),
+        ('DIARREA AGUDA', '\n\n'),
+        ('Texto de la diarrea.', '\n\n'),
+        ('Otro párrafo', '\n\n'),
+    ]
+
+
+def test_long_paragraphs_are_cut_at_the_token_budget():
+    units = list(iter_text_units(["una línea de texto\n" * 30], 20))
+    assert len(units) > 1
+    assert "\n".join(text for text, _ in units) == "\n".join(["una línea de texto"] * 30)